@@ -0,0 +1,266 @@
+'''
+Benchmarks for the solver, evolution and emission hot paths of msynchro.
+
+Each benchmark is timed in the style of timeit: a call is repeated until
+one measurement takes at least --min-time seconds, and the best and median
+time per call over --repeat measurements are recorded. Results are written
+as JSON together with the versions, platform and git commit, so runs on
+different commits can be compared:
+
+    python benchmarks/run.py -o before.json
+    python benchmarks/run.py -o after.json --compare before.json
+
+Use --quick for the smaller sizes only, and --filter to select benchmarks
+by name.
+'''
+import numpy as np
+import argparse
+import datetime
+import platform
+import subprocess
+import time
+import json
+import os
+import sys
+import scipy
+import msynchro
+from msynchro.units import unit
+
+B = 6e-6
+REST_MASS_EV = unit.melec * unit.c * unit.c / unit.ev
+
+BIN_SIZES = [100, 1000, 10000, 100000]
+FREQUENCY_SIZES = [10, 100, 1000]
+QUICK_BIN_SIZES = [100, 1000]
+QUICK_FREQUENCY_SIZES = [10, 100]
+
+
+def cooling_rate(gammas, B, B_CMB=3.24e-6):
+    '''
+    Synchrotron and inverse Compton cooling rate in erg/s, as in tests/test.py
+    '''
+    Utot = (B**2 + B_CMB**2) / 8.0 / np.pi
+    return (4.0 / 3.0 * unit.thomson * unit.c * Utot * gammas * gammas)
+
+
+def energy_grid(nbins):
+    '''
+    The log-spaced grid of tests/test.py with nbins bins
+    '''
+    Emin = np.log10(10.0 * REST_MASS_EV)
+    Emax = np.log10(1e9 * REST_MASS_EV)
+    energy_edges = np.logspace(Emin, Emax, nbins + 1)
+    energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    return (energy_edges, energies)
+
+
+def time_call(func, repeat=5, min_time=0.2):
+    '''
+    Time func() and return the best and median seconds per call and the
+    number of calls per measurement
+    '''
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10.0 else 2
+
+    times = [elapsed / number]
+    for i in range(repeat - 1):
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+
+    return (min(times), float(np.median(times)), number)
+
+
+def bench_tdma_solver(nbins):
+    a = np.zeros(nbins)
+    b = 1.0 + np.random.random(nbins)
+    c = -np.random.random(nbins)
+    d = np.random.random(nbins)
+    return (lambda: msynchro.tdma.TDMASolver(a, b, c, d))
+
+
+def bench_particle_evolve(nbins):
+    energy_edges, energies = energy_grid(nbins)
+    energy_loss_rate = cooling_rate(energy_edges / REST_MASS_EV, B) / unit.ev
+    ne = energies ** -2.5
+    return (lambda: msynchro.evolve.particle_evolve(energy_edges, energy_loss_rate, 0.0, 0.0,
+                                                    ne, 0.01 * unit.myr))
+
+
+def bench_get_dt(nbins):
+    energy_edges, energies = energy_grid(nbins)
+    loss_rate_cen = cooling_rate(energies / REST_MASS_EV, B) / unit.ev
+    ne = energies ** -2.5
+    return (lambda: msynchro.evolve.get_dt(energies, loss_rate_cen, 0.0, 0.0, ne))
+
+
+def bench_psynch(nfreq):
+    gamma = np.logspace(1, 9, 1000)
+    nus = np.logspace(7, 12, nfreq)
+    return (lambda: msynchro.psynch(gamma[np.newaxis, :], nus[:, np.newaxis], B))
+
+
+def bench_ptot(nfreq, nbins):
+    energy_edges, energies = energy_grid(nbins)
+    ne = energies ** -2.5
+    nus = np.logspace(7, 12, nfreq)
+    return (lambda: msynchro.Ptot(nus, energies, ne, B))
+
+
+def run_delta_scenario(nbins=10000):
+    '''
+    The evolution loop of run_delta_test in tests/test.py, without plotting
+    '''
+    energy_edges, energies = energy_grid(nbins)
+    Ebins = energy_edges[1:] - energy_edges[:-1]
+    tmax = 11.0 * unit.myr
+
+    ne = np.zeros_like(energies)
+    ne[np.argmin(np.fabs(energies - 1e12))] = 1
+
+    energy_loss_rate = cooling_rate(energy_edges / REST_MASS_EV, B, 0.0) / unit.ev
+    loss_rate_cen = cooling_rate(energies / REST_MASS_EV, B, 0.0) / unit.ev
+
+    time = 0.0
+    while time < tmax:
+        select = (ne > 1e-50)
+        ne[~select] = 0.0
+        dndt = ne[select] / Ebins[select] * loss_rate_cen[select]
+        delta_t = 0.4 * np.min(ne[select] / dndt)
+        ne = msynchro.evolve.particle_evolve(energy_edges, energy_loss_rate, 0.0, 0.0, ne, delta_t)
+        time += delta_t
+
+    return (ne)
+
+
+def run_powerlaw_scenario(nbins=10000):
+    '''
+    The evolution loops of run_powerlaw_test in tests/test.py, without
+    plotting
+    '''
+    energy_edges, energies = energy_grid(nbins)
+    Ebins = energy_edges[1:] - energy_edges[:-1]
+    tmax = 5.0 * unit.myr
+
+    energy_loss_rate = cooling_rate(energy_edges / REST_MASS_EV, B, 0.0) / unit.ev
+    loss_rate_cen = cooling_rate(energies / REST_MASS_EV, B, 0.0) / unit.ev
+
+    for BETA in np.arange(1, 3.5, 0.5):
+        ne = energies ** -BETA
+        time = 0.0
+        while time < tmax:
+            select = (ne / np.nanmax(ne) > 1e-50)
+            ne[~select] = 0.0
+            dndt = ne[select] / Ebins[select] * loss_rate_cen[select]
+            delta_t = 0.4 * np.min(ne[select] / dndt)
+            ne = msynchro.evolve.particle_evolve(energy_edges, energy_loss_rate, 0.0, 0.0, ne, delta_t)
+            time += delta_t
+
+    return (ne)
+
+
+def benchmarks(quick=False):
+    '''
+    List of (name, parameters, setup) for every benchmark, where setup()
+    returns the function to time
+    '''
+    bin_sizes = QUICK_BIN_SIZES if quick else BIN_SIZES
+    frequency_sizes = QUICK_FREQUENCY_SIZES if quick else FREQUENCY_SIZES
+
+    cases = []
+    for nbins in bin_sizes:
+        cases.append(("tdma_solver", dict(nbins=nbins), lambda n=nbins: bench_tdma_solver(n)))
+        cases.append(("particle_evolve", dict(nbins=nbins), lambda n=nbins: bench_particle_evolve(n)))
+        cases.append(("get_dt", dict(nbins=nbins), lambda n=nbins: bench_get_dt(n)))
+
+    for nfreq in frequency_sizes:
+        cases.append(("psynch", dict(nfreq=nfreq, ngamma=1000), lambda f=nfreq: bench_psynch(f)))
+
+    for nfreq in frequency_sizes:
+        for nbins in bin_sizes:
+            cases.append(("Ptot", dict(nfreq=nfreq, nbins=nbins),
+                          lambda f=nfreq, n=nbins: bench_ptot(f, n)))
+
+    nbins = 1000 if quick else 10000
+    cases.append(("delta_scenario", dict(nbins=nbins), lambda n=nbins: (lambda: run_delta_scenario(n))))
+    cases.append(("powerlaw_scenario", dict(nbins=nbins), lambda n=nbins: (lambda: run_powerlaw_scenario(n))))
+
+    return (cases)
+
+
+def environment():
+    '''
+    Versions, platform and git commit the benchmarks were run with
+    '''
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return dict(commit=commit, msynchro=msynchro.__version__, numpy=np.__version__,
+                scipy=scipy.__version__, python=platform.python_version(),
+                platform=platform.platform(), processor=platform.processor(),
+                cpu_count=os.cpu_count(),
+                date=datetime.datetime.now(datetime.timezone.utc).isoformat())
+
+
+def benchmark_key(result):
+    return (result["name"], tuple(sorted(result["parameters"].items())))
+
+
+def compare(results, fname):
+    '''
+    Print the ratio of each time to the same benchmark in an earlier run
+    '''
+    with open(fname) as f:
+        previous = {benchmark_key(result): result for result in json.load(f)["results"]}
+
+    print ("\nComparison with {} (ratio > 1 is slower)".format(fname))
+    for result in results:
+        old = previous.get(benchmark_key(result))
+        if old is not None:
+            print ("{:20s} {:30s} {:8.3f}".format(result["name"], str(result["parameters"]),
+                                                   result["best"] / old["best"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default="benchmarks.json", help="JSON file to write")
+    parser.add_argument("--quick", action="store_true", help="only run the smaller sizes")
+    parser.add_argument("--filter", default=None, help="only run benchmarks whose name contains this")
+    parser.add_argument("--repeat", type=int, default=5, help="number of measurements")
+    parser.add_argument("--min-time", type=float, default=0.2, help="shortest measurement in seconds")
+    parser.add_argument("--compare", default=None, help="earlier JSON output to compare with")
+    args = parser.parse_args(argv)
+
+    np.random.seed(42)
+    results = []
+    for name, parameters, setup in benchmarks(quick=args.quick):
+        if args.filter is not None and args.filter not in name:
+            continue
+
+        func = setup()
+        best, median, number = time_call(func, repeat=args.repeat, min_time=args.min_time)
+        results.append(dict(name=name, parameters=parameters, best=best, median=median,
+                            number=number, repeat=args.repeat))
+        print ("{:20s} {:30s} {:12.4e} s".format(name, str(parameters), best))
+        sys.stdout.flush()
+
+    with open(args.output, "w") as f:
+        json.dump(dict(environment=environment(), results=results), f, indent=2)
+
+    if args.compare is not None:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
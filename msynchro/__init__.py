@@ -1,4 +1,20 @@
-import tdma
+__version__ = "1.0"
+
+import importlib
+
 from msynchro.msynchro import *
-import msynchro.evolve as evolve
-import msynchro.units as units
\ No newline at end of file
+
+# submodules are imported on first use, e.g. msynchro.evolve, so that
+# importing the package does not pay for ones a process never uses
+_submodules = ("cache", "checkpoint", "evolve", "green", "profiling", "remesh",
+               "snapshots", "sweep", "tdma", "units")
+
+
+def __getattr__(name):
+	if name in _submodules:
+		return importlib.import_module("msynchro." + name)
+	raise AttributeError("module 'msynchro' has no attribute {!r}".format(name))
+
+
+def __dir__():
+	return sorted(set(globals()) | set(_submodules))
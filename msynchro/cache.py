@@ -0,0 +1,258 @@
+import numpy as np
+import functools
+import hashlib
+import inspect
+import msynchro
+import os
+import tempfile
+
+
+class ResultCache:
+	'''
+	Content-addressed cache of arrays on disk. Each result is stored as
+	<key>.npy, or <key>.npz for a tuple of arrays, where the key is the
+	sha256 hash of the function name, its arguments and the package
+	version. When the files in the directory add up to more than max_bytes
+	the least recently used are deleted. Files are written under a
+	temporary name and renamed, so several processes can share a cache.
+
+	Parameters:
+		directory 			str
+							directory to keep the cached results in
+
+		max_bytes 			int
+							largest total size of the cached results
+	'''
+	def __init__(self, directory, max_bytes=2**30):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		os.makedirs(directory, exist_ok=True)
+
+	def key(self, name, arguments):
+		'''
+		Hash a function name and a dict of its arguments. Arrays are hashed
+		by dtype, shape and contents. Raises TypeError for arguments that
+		cannot be hashed reproducibly, such as callables.
+		'''
+		digest = hashlib.sha256()
+		_hash_update(digest, (name, msynchro.__version__, arguments))
+		return (digest.hexdigest())
+
+	def _path(self, key, extension):
+		return (os.path.join(self.directory, key + extension))
+
+	def get(self, key):
+		'''
+		Get the result stored under key, or None if there is none
+		'''
+		for extension in (".npy", ".npz"):
+			path = self._path(key, extension)
+			try:
+				with open(path, "rb") as f:
+					result = np.load(f, allow_pickle=False)
+					if extension == ".npz":
+						result = tuple(result["arr_{}".format(i)] for i in range(len(result.files)))
+			except (FileNotFoundError, ValueError, OSError):
+				continue
+
+			# mark as recently used
+			try:
+				os.utime(path)
+			except FileNotFoundError:
+				pass
+			return (result)
+
+		return (None)
+
+	def put(self, key, result):
+		'''
+		Store an array or tuple of arrays under key, then evict the least
+		recently used results beyond max_bytes
+		'''
+		arrays = result if isinstance(result, tuple) else (result,)
+		if not all(isinstance(array, np.ndarray) and array.dtype != object for array in arrays):
+			raise TypeError("only arrays and tuples of arrays can be cached")
+
+		extension = ".npz" if isinstance(result, tuple) else ".npy"
+		path = self._path(key, extension)
+
+		# a unique temporary file for each writer, including threads
+		fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				if isinstance(result, tuple):
+					np.savez(f, *result)
+				else:
+					np.save(f, result, allow_pickle=False)
+			os.replace(tmp_name, path)
+		except BaseException:
+			os.remove(tmp_name)
+			raise
+
+		self.evict()
+
+	def _entries(self):
+		entries = []
+		for name in os.listdir(self.directory):
+			if name.endswith((".npy", ".npz")):
+				try:
+					stat = os.stat(os.path.join(self.directory, name))
+				except FileNotFoundError:
+					continue
+				entries.append((stat.st_mtime, stat.st_size, name))
+		return (sorted(entries))
+
+	@property
+	def size(self):
+		'''
+		total size of the cached results in bytes
+		'''
+		return (sum(entry[1] for entry in self._entries()))
+
+	def evict(self):
+		'''
+		Delete the least recently used results until the total size is
+		below max_bytes
+		'''
+		entries = self._entries()
+		total = sum(entry[1] for entry in entries)
+		for _, size, name in entries:
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except FileNotFoundError:
+				pass
+			total -= size
+
+	def clear(self):
+		'''
+		Delete every cached result
+		'''
+		for _, _, name in self._entries():
+			try:
+				os.remove(os.path.join(self.directory, name))
+			except FileNotFoundError:
+				pass
+
+
+def _hash_update(digest, value):
+	'''
+	Add a value to a hashlib digest, recursing into containers
+	'''
+	if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+		value = np.ascontiguousarray(value)
+		if value.dtype == object:
+			raise TypeError("object arrays cannot be cached")
+		digest.update("array{}{}".format(value.dtype.str, value.shape).encode())
+		digest.update(value.tobytes())
+	elif value is None or isinstance(value, (bool, int, float, complex, str)):
+		digest.update("{}:{!r};".format(type(value).__name__, value).encode())
+	elif isinstance(value, (tuple, list)):
+		digest.update("{}{};".format(type(value).__name__, len(value)).encode())
+		for item in value:
+			_hash_update(digest, item)
+	elif isinstance(value, dict):
+		digest.update("dict{};".format(len(value)).encode())
+		for name in sorted(value):
+			_hash_update(digest, name)
+			_hash_update(digest, value[name])
+	else:
+		raise TypeError("cannot hash {} for the cache".format(type(value).__name__))
+
+
+_cache = None
+
+
+def enable_cache(directory=None, max_bytes=2**30):
+	'''
+	Turn on caching of the results of Ptot, Ptot_scan, evolve.evolve_until
+	and the psynch kernel table. Identical calls then load the result from
+	disk instead of recomputing it. The cache is off by default.
+
+	Parameters:
+		directory 			str or None
+							where to keep the results. Defaults to the
+							MSYNCHRO_CACHE environment variable, or
+							~/.cache/msynchro
+
+		max_bytes 			int
+							largest total size of the cached results, the
+							least recently used are deleted beyond it
+
+	Returns:
+		cache 				ResultCache
+	'''
+	global _cache
+	if directory is None:
+		directory = os.environ.get("MSYNCHRO_CACHE",
+		                           os.path.join(os.path.expanduser("~"), ".cache", "msynchro"))
+	_cache = ResultCache(directory, max_bytes=max_bytes)
+	return (_cache)
+
+
+def disable_cache():
+	'''
+	Turn off caching. Results already on disk are kept.
+	'''
+	global _cache
+	_cache = None
+
+
+def get_cache():
+	'''
+	The ResultCache in use, or None if caching is off
+	'''
+	return (_cache)
+
+
+def cached(ignore=(), state=None):
+	'''
+	Decorator to cache the result of a function returning an array or a
+	tuple of arrays, when the cache is enabled. The key is made from the
+	bound arguments with defaults filled in, so positional and keyword
+	calls share results. Arguments in ignore, which must not change the
+	result, are left out. Calls with arguments that cannot be hashed, such
+	as callables, are not cached.
+
+	Parameters:
+		ignore 				tuple of str
+							names of arguments left out of the key
+
+		state 				callable or None
+							called with the dict of arguments, returning
+							further values the result depends on that are
+							not arguments, such as a loaded table. They
+							are added to the key
+	'''
+	def decorate(func):
+		signature = inspect.signature(func)
+		name = func.__module__ + "." + func.__qualname__
+
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			cache = _cache
+			if cache is None:
+				return func(*args, **kwargs)
+
+			bound = signature.bind(*args, **kwargs)
+			bound.apply_defaults()
+			arguments = {arg: value for arg, value in bound.arguments.items() if arg not in ignore}
+			if state is not None:
+				arguments = dict(arguments, _state=state(arguments))
+			try:
+				key = cache.key(name, arguments)
+			except TypeError:
+				return func(*args, **kwargs)
+
+			result = cache.get(key)
+			if result is None:
+				result = func(*args, **kwargs)
+				try:
+					cache.put(key, result)
+				except TypeError:
+					pass
+			return result
+
+		return wrapper
+	return decorate
@@ -0,0 +1,188 @@
+from msynchro.evolve import AdaptiveStepper, ScheduledEvolver, iter_snapshots
+import numpy as np
+import hashlib
+import os
+
+
+def input_hash(*arrays):
+	'''
+	sha256 hex digest of the float64 values and shapes of arrays, used to
+	check that a checkpoint is resumed with the same inputs
+	'''
+	digest = hashlib.sha256()
+	for array in arrays:
+		array = np.ascontiguousarray(array, dtype=np.float64)
+		digest.update(str(array.shape).encode())
+		digest.update(array.tobytes())
+	return (digest.hexdigest())
+
+
+def evolver_hash(evolver):
+	'''
+	input_hash of everything that sets the steps taken by an Evolver or
+	AdaptiveStepper: the grid, the loss and escape rates, the source, the
+	scheme and the controller settings. For a ScheduledEvolver the unscaled
+	profiles are hashed, the schedules themselves cannot be.
+	'''
+	arrays = []
+	if isinstance(evolver, AdaptiveStepper):
+		arrays.append([evolver.rtol, evolver.atol, evolver.relative_threshold, evolver.dt_max,
+		               evolver.safety, evolver.min_factor, evolver.max_factor])
+		evolver = evolver.evolver
+
+	if isinstance(evolver, ScheduledEvolver):
+		arrays += [evolver._component_lower, evolver._component_upper, evolver._inv_tloss,
+		           evolver._source]
+	else:
+		arrays += [evolver.rate_lower, evolver.rate_upper, evolver.inv_tloss, evolver.source]
+
+	arrays += [evolver.energy_edges, [evolver.theta, evolver.positive]]
+	return (input_hash(*arrays))
+
+
+def save_checkpoint(fname, evolver, n, time, **state):
+	'''
+	Save the state of an evolution to an .npz file. The file is written
+	under a temporary name and then renamed, so an interrupted save never
+	leaves a corrupt checkpoint behind, only the previous one. Values are
+	stored in binary, so a run resumed from the checkpoint continues
+	bit-for-bit.
+
+	Parameters:
+		fname 				str
+							name of the checkpoint file
+
+		evolver 			Evolver or AdaptiveStepper
+							evolver of the run, whose input hash is saved.
+							The time-step controller state of an
+							AdaptiveStepper is saved as well
+
+		n 					array-like
+							the distribution
+
+		time 				float
+							time of the distribution
+
+		**state 			further values to save, e.g. a step counter
+	'''
+	if isinstance(evolver, AdaptiveStepper):
+		state.update(dt=evolver.dt, accepted=evolver.accepted, rejected=evolver.rejected)
+		edges = evolver.evolver.energy_edges
+	else:
+		edges = evolver.energy_edges
+
+	tmp_name = fname + ".tmp"
+	with open(tmp_name, "wb") as f:
+		np.savez(f, n=n, time=time, energy_edges=edges, input_hash=evolver_hash(evolver),
+		         **state)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_name, fname)
+
+
+def load_checkpoint(fname, evolver=None):
+	'''
+	Load a checkpoint written by save_checkpoint.
+
+	Parameters:
+		fname 				str
+							name of the checkpoint file
+
+		evolver 			Evolver, AdaptiveStepper or None
+							if given, check the checkpoint was written with
+							the same inputs, and restore the time-step
+							controller state of an AdaptiveStepper
+
+	Returns:
+		state 				dict
+							n, time, energy_edges, input_hash and any other
+							saved values
+	'''
+	with np.load(fname) as checkpoint:
+		state = {key: checkpoint[key] for key in checkpoint.files}
+	state["input_hash"] = str(state["input_hash"])
+
+	if evolver is not None:
+		if state["input_hash"] != evolver_hash(evolver):
+			raise ValueError("checkpoint {} was written with different inputs".format(fname))
+
+		if isinstance(evolver, AdaptiveStepper):
+			evolver.time = float(state["time"])
+			evolver.dt = float(state["dt"])
+			evolver.accepted = int(state["accepted"])
+			evolver.rejected = int(state["rejected"])
+
+	return (state)
+
+
+def evolve_checkpointed(evolver, n0, t_end, fname, interval, dt=None, t_start=0.0, resume=True):
+	'''
+	Evolve a particle distribution from t_start to t_end, saving a
+	checkpoint to fname every interval of simulated time. If fname exists
+	and resume is True the run continues from it instead, and the result is
+	bit-for-bit identical to an uninterrupted run, as the checkpoints are
+	at the same times in both. A checkpoint is only resumed if it was
+	written with the same evolver inputs, n0, t_start, interval and t_end,
+	and for an Evolver the same dt. Otherwise ValueError is raised.
+
+	Parameters:
+		evolver 			Evolver or AdaptiveStepper
+							evolver of the run, stepping as in
+							evolve.iter_snapshots
+
+		n0 					array-like
+							len (N-1) array holding initial state
+
+		t_end 				float
+							time to evolve until
+
+		fname 				str
+							name of the checkpoint file
+
+		interval 			float
+							time between checkpoints
+
+		dt 					float or None
+							largest time-step for an Evolver
+
+		t_start 			float
+							time of the initial state
+
+		resume 				bool
+							continue from fname if it exists
+
+	Returns:
+		n_final 			array-like
+							the distribution at t_end
+	'''
+	if interval <= 0.0:
+		raise ValueError("interval must be positive")
+
+	n_checkpoints = max(int(np.ceil((t_end - t_start) / interval)), 1)
+	targets = np.append(t_start + interval * np.arange(1, n_checkpoints), t_end)
+
+	# everything besides the evolver that sets the steps of the run
+	run = dict(t_start=t_start, interval=interval, t_end=t_end, n0_hash=input_hash(n0))
+	if not isinstance(evolver, AdaptiveStepper):
+		run["max_dt"] = dt
+
+	if resume and os.path.exists(fname):
+		state = load_checkpoint(fname, evolver)
+		for key, value in run.items():
+			if key not in state or state[key] != value:
+				raise ValueError("checkpoint {} is for a different run, {} differs".format(fname, key))
+		n = state["n"]
+		done = int(state["checkpoint"])
+		time = float(state["time"])
+	else:
+		if isinstance(evolver, AdaptiveStepper):
+			evolver.time = t_start
+		n = np.array(n0, dtype=float)
+		done = 0
+		time = t_start
+
+	stream = iter_snapshots(evolver, n, targets[done:], dt=dt, t_start=time)
+	for checkpoint, (time, n) in enumerate(stream, start=done + 1):
+		save_checkpoint(fname, evolver, n, time, checkpoint=checkpoint, **run)
+
+	return (n)
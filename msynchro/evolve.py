@@ -1,8 +1,14 @@
 from msynchro.units import unit
+from msynchro.cache import cached
+from msynchro import profiling
+from concurrent.futures import ThreadPoolExecutor
+import msynchro.tdma
 import msynchro
 import numpy as np 
+import time
 
-def particle_evolve(energy_edges, energy_loss_rate, tloss_discrete, source, n_i, dt):
+def particle_evolve(energy_edges, energy_loss_rate, tloss_discrete, source, n_i, dt, out=None,
+	                scheme="implicit", positive=False):
 	'''
 	Evolve a particle distribution for one time step. any units allowed as
 	long as all energy and time units are consistent. Using a TDMA solver to evolve
@@ -22,66 +28,105 @@ def particle_evolve(energy_edges, energy_loss_rate, tloss_discrete, source, n_i,
 							source term, len (N-1)
 
 		n_i 				array-like
-							len (N-1) array holding initial state
+							len (N-1) array holding initial state, or a
+							stacked array of shape (n_systems, N-1) holding
+							many independent populations. In the stacked
+							case energy_loss_rate, tloss_discrete and source
+							may also be given per system (leading axis
+							n_systems) and all systems are solved in a
+							single call to the C extension.
 
-		dt 					float
+		dt 					float or array-like
 							time-step, needs to have consistent units with
-							tloss_discrete and energy_loss_rate
+							tloss_discrete and energy_loss_rate. Can be a
+							len (n_systems) array for stacked n_i.
+
+		out 				array-like or None
+							float64 array with the same shape as n_i to write
+							the result into, which can be n_i itself to update
+							the distribution in place. See Evolver.step for
+							stepping without any temporary arrays.
+
+		scheme 				str or float
+							time discretisation, "implicit" for the first
+							order backward Euler update, "crank-nicolson"
+							for the second order Crank-Nicolson update, or
+							the implicitness theta of a theta-method, from
+							0.5 (Crank-Nicolson) to 1 (backward Euler)
+
+		positive 			bool
+							positivity limiter. If the step gives negative
+							values, which Crank-Nicolson can do at sharp
+							features such as a cooling cutoff, the step is
+							redone with backward Euler
 
 	Returns:
 		n_iplusone 			array-like
 							array holding the distribution at the next time step
 	'''
+	theta = _scheme_theta(scheme)
+	profile = profiling.current()
 
+	# the limiter may need n_i again after the step, so solve out of place
+	if positive and theta < 1.0:
+		n_iplusone = particle_evolve(energy_edges, energy_loss_rate, tloss_discrete, source,
+		                             n_i, dt, scheme=theta)
+		if np.any(n_iplusone < 0.0):
+			if profile is not None:
+				profile.count("particle_evolve.limited")
+			n_iplusone = particle_evolve(energy_edges, energy_loss_rate, tloss_discrete,
+			                             source, n_i, dt)
+		if out is not None:
+			out[...] = n_iplusone
+			n_iplusone = out
+		return (n_iplusone)
 
-	# find the lower and upper bin boundaries, bin centres and bin sizes
-	E1 = energy_edges[:-1]
-	E2 = energy_edges[1:]
-	Ecen = 0.5 * (E1 + E2)
-	Ebins = E2 - E1
+	if profile is not None:
+		start = time.perf_counter()
 
-	# check if energy_loss_rate is array like or scalar
-	if np.isscalar(energy_loss_rate):
-		if energy_loss_rate == None or energy_loss_rate == 0.0:
-			loss_term = 0.0
-			v3_loss_term = 0.0
-		else:
-			# allow for constant loss rate
-			loss_term = np.ones_like(Ecen) * energy_loss_rate * dt
-			v3_loss_term = -np.ones_like(Ecen) * energy_loss_rate * dt
-	else:
-		# get the j+1/2 and j-1/2 energy loss rates 
-		Edot1 = energy_loss_rate[:-1]
-		Edot2 = energy_loss_rate[1:]
-		loss_term = (dt * Edot1 / Ebins)
-		v3_loss_term = -dt * Edot2 / Ebins
-
-	# check if tloss_discrete is array like or scalar
-	if np.isscalar(tloss_discrete):
-		if tloss_discrete == None or tloss_discrete == 0.0:
-			discrete_term = 0.0
-		else:
-			# allow for single timescale
-			discrete_term = (dt / tloss_discrete)
-	else:
-		discrete_term = (dt / tloss_discrete)
+	n_i = np.asarray(n_i)
+	batched = (n_i.ndim == 2)
+
+	# one time-step per system, broadcast along the energy axis
+	if batched and not np.isscalar(dt):
+		dt = np.asarray(dt, dtype=float).reshape(-1, 1)
+
+	# get the rates that multiply dt in the TDMA coefficients
+	rate_lower, rate_upper, inv_tloss = _loss_rates(energy_edges, energy_loss_rate, tloss_discrete)
 
-	# set up the four terms to pass to the TDMA solver 
-	a = np.zeros_like(Ecen)
-	b = 1.0 + loss_term + discrete_term
-	c = v3_loss_term * np.ones_like(Ecen)
+	# set up the terms to pass to the TDMA solver. The sub-diagonal a is
+	# zero for this scheme, so the system is upper bidiagonal and is solved
+	# by back substitution alone, skipping the empty bins at the top
+	b = 1.0 + (theta * dt) * (rate_lower + inv_tloss)
+	c = -(theta * dt) * rate_upper
 	d = n_i + (source * dt)
 
-	# run the TDMA solver 
-	n_iplusone = msynchro.tdma.TDMASolver(a, b, c, d)
+	# explicit part of the loss operator for theta < 1
+	if theta < 1.0:
+		d = d - ((1.0 - theta) * dt) * _loss_operator(rate_lower + inv_tloss, rate_upper, n_i)
+
+	if profile is not None:
+		start = profile.lap("particle_evolve.setup", start)
+
+	# run the solver, solving every system in one call if batched
+	n_iplusone = msynchro.tdma.BidiagonalSolver(b, c, d, out=out)
+
+	if profile is not None:
+		profile.lap("particle_evolve.solve", start)
+		profile.count("particle_evolve.steps", len(n_i) if batched else 1)
+		profile.count("particle_evolve.active_bins", np.count_nonzero(n_iplusone))
 
 	return (n_iplusone)
 
 
-def get_dt(energies, loss_rate_cen, tloss_discrete, source, n_i, relative_threshold=1e-15):
+
+def steady_state(energy_edges, energy_loss_rate, tloss_discrete, source):
 	'''
-	Calculate a time step. Units consistent with
-	tloss_discrete and energy_loss_rate
+	Get the steady-state particle distribution, where dn/dt = 0, directly
+	rather than by evolving until the distribution stops changing. Uses the
+	same discretisation as particle_evolve, so the result is the state that
+	particle_evolve converges to for any time-step. Setting n_iplusone =
+	n_i in the update gives one bidiagonal system, solved in O(N).
 
 	Parameters:
 		energy_edges 		array-like
@@ -93,45 +138,988 @@ def get_dt(energies, loss_rate_cen, tloss_discrete, source, n_i, relative_thresh
 		tloss_discrete 		array-like or float
 							tau_loss in each bin, len (N-1)
 
+		source 				array-like
+							source term, len (N-1), or (n_systems, N-1)
+
+	Returns:
+		n_steady 			array-like
+							the steady-state distribution
+	'''
+	rate_lower, rate_upper, inv_tloss = _loss_rates(energy_edges, energy_loss_rate, tloss_discrete)
+
+	# dividing the particle_evolve system by dt and letting dt -> infinity
+	b = rate_lower + inv_tloss
+	c = -rate_upper
+	d = np.asarray(source, dtype=float) + np.zeros(len(energy_edges) - 1)
+
+	if np.any(b == 0.0):
+		raise ValueError("no steady state: some bins have neither losses "
+		                 "through their lower edge nor escape")
+
+	return msynchro.tdma.BidiagonalSolver(b, c, d)
+
+def get_dt(energies, loss_rate_cen, tloss_discrete, source, n_i, relative_threshold=1e-15,
+	       courant=0.4):
+	'''
+	Calculate a time step as courant times the shortest cooling time
+	E / Edot or escape time over the populated bins. Units consistent with
+	tloss_discrete and energy_loss_rate. See AdaptiveStepper for time steps
+	chosen from an error estimate instead.
+
+	For a stack of systems, n_i of shape (n_systems, N-1), the populated
+	bins are found for each system separately and one time step is
+	returned, the minimum over all systems, as particle_evolve takes a
+	single dt for the whole stack.
+
+	Parameters:
+		energies 			array-like
+							energies of bin centres, len (N-1)
+
+		loss_rate_cen 		array-like or float
+							dE/dt at bin centres, len (N-1). None or zero
+							means no continuous losses
+
+		tloss_discrete 		array-like or float
+							tau_loss in each bin, len (N-1). None or zero
+							means no discrete losses
+
 		source 				array-like
 							source term, len (N-1)
 
 		n_i 				array-like
+							len (N-1) array holding initial state, or
+							(n_systems, N-1)
+
+		relative_threshold 	float
+							bins below this fraction of the maximum of their
+							system are ignored. If every bin of a system is
+							empty all its bins are used
+
+		courant 			float
+							fraction of the shortest timescale to use
+
+	Returns:
+		delta_t 			float
+							time step, the smallest over all systems, or
+							np.inf if there are no losses
+	'''
+	profile = profiling.current()
+	if profile is not None:
+		start = time.perf_counter()
+
+	n_i = np.asarray(n_i)
+	energies = np.broadcast_to(np.asarray(energies, dtype=float), n_i.shape)
+
+	# the timescales do not depend on n_i, which only selects the bins
+	populated = np.any(n_i > 0.0, axis=-1, keepdims=True)
+	select = (n_i > np.max(n_i, axis=-1, keepdims=True) * relative_threshold) | ~populated
+
+	# cooling and escape times, infinite where there are no losses
+	if loss_rate_cen is None:
+		loss_rate_cen = 0.0
+	loss_rate_cen = np.broadcast_to(np.asarray(loss_rate_cen, dtype=float), n_i.shape)
+	t_cool = np.full(n_i.shape, np.inf)
+	np.divide(energies, loss_rate_cen, out=t_cool, where=(loss_rate_cen != 0.0))
+
+	inv_tloss = np.broadcast_to(_inverse_timescale(tloss_discrete, n_i.shape[-1]), n_i.shape)
+	t_esc = np.full(n_i.shape, np.inf)
+	np.divide(1.0, inv_tloss, out=t_esc, where=(inv_tloss != 0.0))
+
+	delta_t = courant * min(np.min(t_cool[select]), np.min(t_esc[select]))
+
+	if profile is not None:
+		profile.lap("get_dt", start)
+		profile.count("get_dt.calls")
+		profile.count("get_dt.active_bins", np.count_nonzero(select))
+
+	return (delta_t)
+
+def _inverse_timescale(tloss_discrete, nbins):
+	'''
+	Convert tloss_discrete to an array of 1/tloss, len (nbins) for a scalar,
+	with a timescale of None or zero meaning no discrete losses.
+	'''
+	if tloss_discrete is None:
+		return np.zeros(nbins)
+
+	tloss = np.asarray(tloss_discrete, dtype=float)
+	if tloss.ndim == 0:
+		tloss = np.full(nbins, float(tloss))
+	inv_tloss = np.zeros_like(tloss)
+	np.divide(1.0, tloss, out=inv_tloss, where=(tloss != 0.0))
+	return (inv_tloss)
+
+
+def _scheme_theta(scheme):
+	'''
+	Convert the scheme argument of particle_evolve to the implicitness theta
+	'''
+	if scheme == "implicit":
+		return (1.0)
+	elif scheme == "crank-nicolson":
+		return (0.5)
+	elif np.isscalar(scheme) and not isinstance(scheme, str) and 0.5 <= scheme <= 1.0:
+		return (float(scheme))
+	else:
+		raise ValueError("scheme must be 'implicit', 'crank-nicolson' or a theta "
+		                 "between 0.5 and 1, got {!r}".format(scheme))
+
+
+def _loss_operator(rate_diagonal, rate_upper, n, out=None, work=None):
+	'''
+	Rate of change of n from losses and escape, with the sign convention
+	dn/dt = source - L n, i.e. (L n)_j = rate_diagonal_j n_j - rate_upper_j n_j+1
+	'''
+	if out is None:
+		out = np.empty(np.broadcast(rate_diagonal, n).shape)
+	if work is None:
+		work = np.empty(out.shape)
+
+	np.multiply(rate_diagonal, n, out=out)
+	np.multiply(rate_upper[..., :-1], n[..., 1:], out=work[..., :-1])
+	out[..., :-1] -= work[..., :-1]
+	return (out)
+
+
+def _loss_rates(energy_edges, energy_loss_rate, tloss_discrete):
+	'''
+	Get the rates that set the TDMA coefficients for a time-step dt, so that
+	b = 1 + dt * (rate_lower + inv_tloss) and c = -dt * rate_upper. Arrays
+	keep any leading (n_systems) axis of energy_loss_rate and tloss_discrete.
+	'''
+	energy_edges = np.asarray(energy_edges, dtype=float)
+	Ebins = energy_edges[1:] - energy_edges[:-1]
+	nbins = len(Ebins)
+
+	# check if energy_loss_rate is array like or scalar
+	if energy_loss_rate is None or np.isscalar(energy_loss_rate):
+		if energy_loss_rate is None:
+			energy_loss_rate = 0.0
+		# allow for constant loss rate
+		rate_lower = np.full(nbins, float(energy_loss_rate))
+		rate_upper = np.full(nbins, float(energy_loss_rate))
+	else:
+		# get the j+1/2 and j-1/2 energy loss rates 
+		energy_loss_rate = np.asarray(energy_loss_rate, dtype=float)
+		rate_lower = energy_loss_rate[..., :-1] / Ebins
+		rate_upper = energy_loss_rate[..., 1:] / Ebins
+
+	inv_tloss = _inverse_timescale(tloss_discrete, nbins)
+
+	return (rate_lower, rate_upper, inv_tloss)
+
+
+@cached()
+def evolve_until(energy_edges, energy_loss_rate, tloss_discrete, source, n0, t_end,
+	             t_snap=None, t_start=0.0, courant=0.4, relative_threshold=1e-15,
+	             loss_rate_cen=None):
+	'''
+	Evolve a particle distribution from t_start to t_end with adaptive time
+	steps, with the whole time loop run inside the C extension. At each step
+	bins below relative_threshold times the maximum are set to zero and the
+	time-step is courant times the shortest bin-crossing time
+	(Ebins / loss_rate_cen) or escape time of the populated bins. Each step
+	is the same backward-Euler update as particle_evolve, including a scalar
+	energy_loss_rate being taken as a rate as it is there. Steps are
+	shortened to land exactly on the snapshot times and t_end. If a
+	time-step becomes too small to change the time, e.g. a very large
+	t_start with fast losses, RuntimeError is raised instead of looping
+	forever.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of energy bins, len(N)
+
+		energy_loss_rate 	array-like or float
+							dE/dt at edges of energy bins, len (N)
+
+		tloss_discrete 		array-like or float
+							tau_loss in each bin, len (N-1). None or zero
+							means no discrete losses
+
+		source 				array-like or float
+							source term, len (N-1)
+
+		n0 					array-like
 							len (N-1) array holding initial state
 
+		t_end 				float
+							time to evolve until
+
+		t_snap 				array-like or None
+							sorted times at which to record the distribution,
+							between t_start and t_end
+
+		t_start 			float
+							time of the initial state
+
+		courant 			float
+							fraction of the shortest bin timescale to use
+							as the time-step
+
+		relative_threshold 	float
+							bins below this fraction of the maximum are
+							treated as empty
+
+		loss_rate_cen 		array-like or None
+							dE/dt at bin centres, len (N-1), used for the
+							time-step. Defaults to the mean of the rates at
+							the bin edges
 
 	Returns:
-		n_iplusone 			array-like
-							array holding the distribution at the next time step
+		n_final 			array-like
+							the distribution at t_end
+
+		snapshots 			array-like
+							only if t_snap is given, array of shape
+							(len(t_snap), N-1) holding the distribution at
+							each snapshot time
 	'''
-	
-	if np.all(n_i == 0.0):
-		return (0.0)
+	energy_edges = np.asarray(energy_edges, dtype=float)
+	nbins = len(energy_edges) - 1
+
+	if courant <= 0.0:
+		raise ValueError("courant must be positive")
+
+	# the C loop cannot be interrupted, so it must have a finite end
+	if not np.isfinite(t_end) or t_end < t_start:
+		raise ValueError("t_end must be finite and not before t_start")
 
-	minimum_n_i = np.max(n_i) * relative_threshold
-	#print (np.max(n_i), minimum_n_i)
-	select = (n_i > minimum_n_i)
+	# the same coefficients as particle_evolve, so a scalar loss rate keeps
+	# its meaning of a rate rather than dE/dt
+	rate_lower, rate_upper, inv_tloss = _loss_rates(energy_edges, energy_loss_rate, tloss_discrete)
+	rate_lower = np.broadcast_to(rate_lower, (nbins,))
+	rate_upper = np.broadcast_to(rate_upper, (nbins,))
 
-	if np.isscalar(loss_rate_cen):
-		if loss_rate_cen == 0.0:
-			dndt1 = 0.0
-		else:
-			dndt1 = n_i[select] / energies[select] * loss_rate_cen
+	if loss_rate_cen is None:
+		rate_cen = 0.5 * (rate_lower + rate_upper)
 	else:
-		dndt1 = n_i[select] / energies[select] * loss_rate_cen[select]
+		Ebins = energy_edges[1:] - energy_edges[:-1]
+		rate_cen = np.broadcast_to(np.asarray(loss_rate_cen, dtype=float), (nbins,)) / Ebins
+	source = np.broadcast_to(np.asarray(source, dtype=float), (nbins,))
 
-	if np.isscalar(tloss_discrete):
-		if tloss_discrete == 0.0:
-			dndt2 = 0.0
-		else:
-			dndt2 = n_i[select] / tloss_discrete
+	# the C loop returns the state at every target time, the last being t_end
+	if t_snap is None:
+		targets = np.array([t_end], dtype=float)
 	else:
-		dndt2 = n_i[select] / tloss_discrete[select]
+		t_snap = np.asarray(t_snap, dtype=float)
+		if np.any(np.diff(t_snap) < 0) or np.any(t_snap < t_start) or np.any(t_snap > t_end):
+			raise ValueError("t_snap must be sorted and lie between t_start and t_end")
+		targets = np.append(t_snap, t_end)
+
+	profile = profiling.current()
+	if profile is not None:
+		start = time.perf_counter()
+
+	states, nsteps = msynchro.tdma.EvolveUntil(rate_lower, rate_upper, rate_cen, inv_tloss,
+	                                           source, n0, targets, t_start, courant,
+	                                           relative_threshold)
+
+	if profile is not None:
+		profile.lap("evolve_until.solve", start)
+		profile.count("evolve_until.steps", nsteps)
+
+	if t_snap is None:
+		return (states[-1])
+	else:
+		return (states[-1], states[:-1])
+
+
+
+def evolve_many(jobs, max_workers=None, **shared):
+	'''
+	Evolve several particle distributions concurrently with evolve_until on
+	a pool of threads. The C extension releases the GIL while it evolves a
+	distribution, so the populations are evolved in parallel on separate
+	cores without copying any arrays between processes.
+
+	Parameters:
+		jobs 				sequence of dict
+							keyword arguments of evolve_until for each
+							population, e.g. dict(n0=n0, t_end=t_end)
+
+		max_workers 		int or None
+							number of threads, defaults to the
+							ThreadPoolExecutor default
+
+		**shared 			keyword arguments of evolve_until common to every
+							job, e.g. energy_edges. Values in a job take
+							precedence
+
+	Returns:
+		results 			list
+							the return value of evolve_until for each job,
+							in the same order as jobs
+	'''
+	def run(job):
+		kwargs = dict(shared)
+		kwargs.update(job)
+		return evolve_until(**kwargs)
+
+	with ThreadPoolExecutor(max_workers=max_workers) as pool:
+		return list(pool.map(run, jobs))
+
+
+def analytic_cool(energy_edges, n0, C, t):
+	'''
+	Evolve a particle distribution under pure synchrotron or inverse
+	Compton cooling, dE/dt = -C E^2, with no source and no escape, using
+	the exact solution rather than time steps. A particle with energy E0 at
+	t = 0 has energy E0 / (1 + C E0 t) at time t, so each bin is mapped
+	along these characteristics and its particles are shared between the
+	original bins it overlaps, assuming they stay uniformly spread in
+	energy within the bin. The number of particles is conserved, apart
+	from those that cool below the lowest edge and leave the grid.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of energy bins, len(N)
+
+		n0 					array-like
+							len (N-1) array holding initial state
+
+		C 					float
+							cooling constant, so that the energy loss rate
+							is C E^2 in the same units as energy_edges
+
+		t 					float
+							time to evolve for, with units consistent with C
+
+	Returns:
+		n_t 				array-like
+							array holding the distribution at time t
+	'''
+	energy_edges = np.asarray(energy_edges, dtype=float)
+	Ebins = energy_edges[1:] - energy_edges[:-1]
+
+	# where each edge has cooled to by time t
+	cooled_edges = energy_edges / (1.0 + C * energy_edges * t)
+
+	# cumulative number of particles below each cooled edge, interpolated
+	# onto the original edges
+	cumulative = np.zeros_like(energy_edges)
+	cumulative[1:] = np.cumsum(np.asarray(n0, dtype=float) * Ebins)
+	cumulative = np.interp(energy_edges, cooled_edges, cumulative)
+
+	return (np.diff(cumulative) / Ebins)
+
+class Evolver:
+	'''
+	Evolve particle distributions on a fixed energy grid with fixed loss
+	rates, escape times and source. All grid and loss-rate dependent
+	quantities are computed once on creation, so each call to step only
+	scales them by dt and runs the TDMA solver. Steps are identical to
+	particle_evolve with the same arguments. The coefficient and scratch
+	arrays are owned by the Evolver, so stepping with out= does not
+	allocate any arrays.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of energy bins, len(N)
+
+		energy_loss_rate 	array-like or float
+							dE/dt at edges of energy bins, len (N)
+
+		tloss_discrete 		array-like or float
+							tau_loss in each bin, len (N-1)
+
+		source 				array-like or float
+							source term, len (N-1)
+
+		scheme 				str or float
+							time discretisation, see particle_evolve
+
+		positive 			bool
+							positivity limiter, see particle_evolve
+	'''
+	def __init__(self, energy_edges, energy_loss_rate, tloss_discrete, source,
+		         scheme="implicit", positive=False):
+
+		# find the lower and upper bin boundaries, bin centres and bin sizes
+		self.energy_edges = np.asarray(energy_edges, dtype=float)
+		self.E1 = self.energy_edges[:-1]
+		self.E2 = self.energy_edges[1:]
+		self.Ecen = 0.5 * (self.E1 + self.E2)
+		self.Ebins = self.E2 - self.E1
+		self.nbins = len(self.Ebins)
+
+		self.rate_lower, self.rate_upper, self.inv_tloss = _loss_rates(
+			self.energy_edges, energy_loss_rate, tloss_discrete)
+		self.rate_diagonal = self.rate_lower + self.inv_tloss
+		self.source = np.asarray(source, dtype=float)
+		self.theta = _scheme_theta(scheme)
+		self.positive = positive
+
+		# coefficient buffers, reused on every step. the sub-diagonal is
+		# always zero for this scheme so no a or scratch space is needed
+		self._b = np.empty_like(self.rate_diagonal)
+		self._c = np.empty_like(self.rate_upper)
+		self._d = np.empty(self.nbins)
+		self._work = np.empty(self.nbins)
+		self._x = np.empty(self.nbins)
+
+	def step(self, n_i, dt, out=None):
+		'''
+		Evolve a particle distribution for one time step.
+
+		Parameters:
+			n_i 				array-like
+								len (N-1) array holding initial state, or
+								(n_systems, N-1) stacked populations
+
+			dt 					float
+								time-step
+
+			out 				array-like or None
+								float64 array with the same shape as n_i to
+								write the result into, which can be n_i itself
+
+		Returns:
+			n_iplusone 			array-like
+								array holding the distribution at the next time step
+		'''
+		n_i = np.asarray(n_i)
+		if self._d.shape != n_i.shape:
+			self._d = np.empty(n_i.shape)
+			self._work = np.empty(n_i.shape)
+			self._x = np.empty(n_i.shape)
+
+		if self.theta == 1.0:
+			return self._step(n_i, dt, 1.0, out)
+
+		# the limiter may need n_i again after the step, so solve out of place
+		n_iplusone = self._step(n_i, dt, self.theta, self._x if self.positive else out)
+		if self.positive:
+			if np.any(n_iplusone < 0.0):
+				profile = profiling.current()
+				if profile is not None:
+					profile.count("Evolver.limited")
+				self._step(n_i, dt, 1.0, n_iplusone)
+			if out is None:
+				out = np.empty(n_i.shape)
+			out[...] = n_iplusone
+			n_iplusone = out
+
+		return n_iplusone
+
+	def _step(self, n_i, dt, theta, out):
+		'''
+		One step of the theta-method, using the coefficient buffers
+		'''
+		profile = profiling.current()
+		if profile is not None:
+			start = time.perf_counter()
+
+		# b = 1 + theta dt rate_diagonal, c = -theta dt rate_upper,
+		# d = n_i + source dt - (1 - theta) dt L n_i
+		np.multiply(self.rate_diagonal, theta * dt, out=self._b)
+		self._b += 1.0
+		np.multiply(self.rate_upper, -(theta * dt), out=self._c)
+		np.multiply(self.source, dt, out=self._d)
+		self._d += n_i
+
+		if theta < 1.0:
+			_loss_operator(self.rate_diagonal, self.rate_upper, n_i, out=self._work, work=self._x)
+			self._work *= (1.0 - theta) * dt
+			self._d -= self._work
+
+		if profile is None:
+			return msynchro.tdma.BidiagonalSolver(self._b, self._c, self._d, out=out)
+
+		start = profile.lap("Evolver.setup", start)
+		n_iplusone = msynchro.tdma.BidiagonalSolver(self._b, self._c, self._d, out=out)
+		profile.lap("Evolver.solve", start)
+		profile.count("Evolver.steps", len(n_i) if n_i.ndim == 2 else 1)
+		profile.count("Evolver.active_bins", np.count_nonzero(n_iplusone))
+		return n_iplusone
+
+
+
+def _schedule(schedule):
+	'''
+	Convert a schedule to a function of time. A schedule is a constant, a
+	callable f(t), or a (times, values) pair interpolated linearly in time,
+	with one value (or row of values) per time and constant values outside
+	the table
+	'''
+	if callable(schedule):
+		return (schedule)
+
+	if isinstance(schedule, tuple):
+		times = np.asarray(schedule[0], dtype=float)
+		values = np.asarray(schedule[1], dtype=float)
+		if len(times) != len(values):
+			raise ValueError("schedule has {} times but {} values".format(len(times), len(values)))
+		if len(times) == 1:
+			return (lambda t: values[0])
+
+		def interpolate(t):
+			i = min(max(np.searchsorted(times, t, side="right") - 1, 0), len(times) - 2)
+			w = min(max((t - times[i]) / (times[i + 1] - times[i]), 0.0), 1.0)
+			return ((1.0 - w) * values[i] + w * values[i + 1])
+		return (interpolate)
+
+	return (lambda t: schedule)
+
+
+class ScheduledEvolver(Evolver):
+	'''
+	Evolver for loss rates, escape times and source that change with time,
+	e.g. an expanding lobe with a magnetic field B(t). Each input is a fixed
+	energy profile multiplied by a schedule,
+
+		energy_loss_rate(E, t) = sum_k loss_scale(t)[k] * energy_loss_rate[k](E)
+		1 / tloss(E, t) = escape_scale(t) / tloss_discrete(E)
+		source(E, t) = source_scale(t) * source(E)
+
+	so the loss profiles are computed once, e.g. synchrotron losses for B = 1
+	scaled by B(t)^2 plus inverse Compton losses scaled by 1. update(t)
+	rescales the cached TDMA rates, and only for the schedules whose value
+	has changed since the last update.
+
+	A schedule is a constant, a callable f(t), or a tuple (times, values)
+	interpolated linearly in time. Escape and source schedules can return
+	arrays, len (N-1), to change the shape of the profile as well.
+
+	Steps are the same as Evolver.step with the inputs at the time set by
+	the last update. step_at updates to t + theta * dt and steps from t,
+	which is backward Euler at the end of the step, and Crank-Nicolson at
+	the midpoint. AdaptiveStepper updates the inputs itself.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of energy bins, len(N)
+
+		energy_loss_rate 	array-like or float
+							dE/dt at edges of energy bins, len (N), or
+							(n_components, N) for several loss processes
+							with their own schedules
+
+		tloss_discrete 		array-like or float
+							tau_loss in each bin, len (N-1)
+
+		source 				array-like or float
+							source term, len (N-1)
+
+		loss_scale 			schedule
+							factor on each loss component, a scalar or
+							len (n_components)
+
+		escape_scale 		schedule
+							factor on 1 / tloss_discrete
+
+		source_scale 		schedule
+							factor on source
+
+		time 				float
+							time to evaluate the schedules at on creation
+
+		scheme, positive 	see particle_evolve
+	'''
+	def __init__(self, energy_edges, energy_loss_rate, tloss_discrete, source, loss_scale=1.0,
+		         escape_scale=1.0, source_scale=1.0, time=0.0, scheme="implicit", positive=False):
+
+		Evolver.__init__(self, energy_edges, None, tloss_discrete, source, scheme=scheme,
+		                 positive=positive)
+
+		# unscaled rates, one row per loss component
+		rate_lower, rate_upper, _ = _loss_rates(self.energy_edges, energy_loss_rate, None)
+		self._component_lower = np.atleast_2d(rate_lower)
+		self._component_upper = np.atleast_2d(rate_upper)
+		self.n_components = len(self._component_lower)
+		self._inv_tloss = self.inv_tloss.copy()
+		self._source = np.array(np.broadcast_to(self.source, (self.nbins,)), dtype=float)
+		self.source = self._source.copy()
+
+		self.loss_scale = _schedule(loss_scale)
+		self.escape_scale = _schedule(escape_scale)
+		self.source_scale = _schedule(source_scale)
+		self._scales = dict(loss=None, escape=None, source=None)
+
+		self.time = None
+		self.update(time)
+
+	def _changed(self, name, value):
+		'''
+		Record the value of a schedule, and whether it differs from the last
+		'''
+		value = np.array(value, dtype=float)
+		if self._scales[name] is not None and np.array_equal(value, self._scales[name]):
+			return (False)
+		self._scales[name] = value
+		return (True)
+
+	def update(self, t):
+		'''
+		Set the loss rates, escape rates and source to their values at time t,
+		recomputing only the terms whose schedules have changed.
+
+		Parameters:
+			t 					float
+								time to evaluate the schedules at
+		'''
+		self.time = t
+		diagonal = False
+
+		if self._changed("loss", self.loss_scale(t)):
+			scale = np.broadcast_to(self._scales["loss"], (self.n_components,))
+			np.dot(scale, self._component_lower, out=self.rate_lower)
+			np.dot(scale, self._component_upper, out=self.rate_upper)
+			diagonal = True
+
+		if self._changed("escape", self.escape_scale(t)):
+			np.multiply(self._inv_tloss, self._scales["escape"], out=self.inv_tloss)
+			diagonal = True
+
+		if diagonal:
+			np.add(self.rate_lower, self.inv_tloss, out=self.rate_diagonal)
+
+		if self._changed("source", self.source_scale(t)):
+			np.multiply(self._source, self._scales["source"], out=self.source)
+
+	def step_at(self, t, n_i, dt, out=None):
+		'''
+		Evolve a particle distribution for one time step from time t, with
+		the inputs evaluated at t + theta * dt.
+
+		Parameters:
+			t 					float
+								time at the start of the step
+
+			n_i, dt, out 		see Evolver.step
+
+		Returns:
+			n_iplusone 			array-like
+								array holding the distribution at t + dt
+		'''
+		self.update(t + self.theta * dt)
+		return (self.step(n_i, dt, out=out))
+
+
+def evolve_scheduled(energy_edges, energy_loss_rate, tloss_discrete, source, n0, t_end, dt,
+	                 t_start=0.0, loss_scale=1.0, escape_scale=1.0, source_scale=1.0,
+	                 scheme="implicit"):
+	'''
+	Evolve a particle distribution from t_start to t_end with fixed time
+	steps and time-dependent inputs, see ScheduledEvolver. The last step is
+	shortened to land on t_end.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of energy bins, len(N)
+
+		energy_loss_rate 	array-like or float
+							dE/dt at edges of energy bins, len (N), or
+							(n_components, N)
+
+		tloss_discrete 		array-like or float
+							tau_loss in each bin, len (N-1)
+
+		source 				array-like or float
+							source term, len (N-1)
+
+		n0 					array-like
+							len (N-1) array holding initial state
+
+		t_end 				float
+							time to evolve until
+
+		dt 					float
+							time-step
+
+		t_start 			float
+							time of the initial state
+
+		loss_scale, escape_scale, source_scale
+							schedules, see ScheduledEvolver
+
+		scheme 				str or float
+							time discretisation, see particle_evolve
+
+	Returns:
+		n_final 			array-like
+							the distribution at t_end
+	'''
+	evolver = ScheduledEvolver(energy_edges, energy_loss_rate, tloss_discrete, source,
+	                           loss_scale=loss_scale, escape_scale=escape_scale,
+	                           source_scale=source_scale, time=t_start, scheme=scheme)
+
+	n = np.array(n0, dtype=float)
+	t = t_start
+	while t < t_end:
+		step = min(dt, t_end - t)
+		evolver.step_at(t, n, step, out=n)
+		t = t_end if step < dt else t + step
+
+	return (n)
+
+
+class AdaptiveStepper:
+	'''
+	Error-controlled time stepping for an Evolver. Each step of length dt
+	is also taken as two steps of dt / 2, and the difference between the
+	two results estimates the local error of the update. The step is
+	accepted if the error is below atol + rtol * |n| in every populated
+	bin, keeping the more accurate two half steps. The next dt is scaled by
+	safety * error^(-1/(order+1)) within [min_factor, max_factor], where
+	order is 2 for Crank-Nicolson and 1 otherwise, so dt grows while the
+	solution is smooth. The implicit update is unconditionally stable, so
+	only accuracy limits dt.
+
+	The state of the controller is held in the attributes time, dt,
+	accepted and rejected. The inputs of a ScheduledEvolver are updated
+	for each trial step in the same way as ScheduledEvolver.step_at.
+
+	Parameters:
+		evolver 			Evolver
+							evolver holding the grid, losses and source
+
+		rtol 				float
+							relative tolerance per step
+
+		atol 				float
+							absolute tolerance per step
+
+		relative_threshold 	float
+							only bins above this fraction of the maximum at
+							the start of a step count towards the error, so
+							the nearly empty bins that the implicit update
+							spreads particles into do not limit the step
+
+		dt 					float or None
+							first time-step to try. Defaults to 0.4 times the
+							shortest bin-crossing or escape time
+
+		dt_max 				float
+							largest time-step allowed
+
+		time 				float
+							time of the initial state
+
+		safety 				float
+							safety factor on the step size update
+
+		min_factor 			float
+							smallest factor dt can shrink by in one step
+
+		max_factor 			float
+							largest factor dt can grow by in one step
+	'''
+	def __init__(self, evolver, rtol=1e-3, atol=0.0, relative_threshold=1e-15, dt=None,
+		         dt_max=np.inf, time=0.0, safety=0.9, min_factor=0.2, max_factor=5.0):
+
+		self.evolver = evolver
+		self.rtol = rtol
+		self.atol = atol
+		self.relative_threshold = relative_threshold
+		self.dt_max = dt_max
+		self.safety = safety
+		self.min_factor = min_factor
+		self.max_factor = max_factor
+
+		if dt is None:
+			fastest = np.max(evolver.rate_diagonal)
+			dt = 0.4 / fastest if fastest > 0.0 else dt_max
+		self.dt = min(dt, dt_max)
+
+		# Crank-Nicolson is second order, other theta-methods first order
+		self.order = 2 if evolver.theta == 0.5 else 1
+
+		self.time = time
+		self.accepted = 0
+		self.rejected = 0
+
+	@property
+	def stats(self):
+		'''
+		dict of the number of accepted and rejected steps and the current dt
+		'''
+		return dict(accepted=self.accepted, rejected=self.rejected, dt=self.dt)
+
+	def error_norm(self, n, n_full, n_half):
+		'''
+		Largest ratio of the estimated local error to the tolerance over the
+		bins populated at the start of the step
+		'''
+		abs_n = np.abs(n)
+		select = (abs_n > np.max(abs_n) * self.relative_threshold)
+		if not np.any(select):
+			select = (n_half != 0.0)
+
+		scale = self.atol + self.rtol * np.maximum(abs_n, np.abs(n_half))
+		error = np.abs(n_half - n_full)
+
+		ratio = np.zeros_like(error)
+		np.divide(error, scale, out=ratio, where=(scale > 0.0))
+		ratio[(scale == 0.0) & (error > 0.0)] = np.inf
+		return np.max(ratio[select], initial=0.0)
+
+	def _update(self, t, dt):
+		'''
+		Set the inputs of a ScheduledEvolver for a step of dt from t
+		'''
+		if isinstance(self.evolver, ScheduledEvolver):
+			self.evolver.update(t + self.evolver.theta * dt)
+
+	def advance(self, n, t_end):
+		'''
+		Evolve a distribution from the current time to t_end.
+
+		Parameters:
+			n 					array-like
+								distribution at the current time
+
+			t_end 				float
+								time to evolve until
+
+		Returns:
+			n_end 				array-like
+								distribution at t_end
+		'''
+		n = np.array(n, dtype=float)
+		n_full = np.empty_like(n)
+		n_half = np.empty_like(n)
+
+		while self.time < t_end:
+			dt = min(self.dt, t_end - self.time)
+			clipped = (dt < self.dt)
+
+			# one full step and two half steps
+			self._update(self.time, dt)
+			self.evolver.step(n, dt, out=n_full)
+			self._update(self.time, 0.5 * dt)
+			self.evolver.step(n, 0.5 * dt, out=n_half)
+			self._update(self.time + 0.5 * dt, 0.5 * dt)
+			self.evolver.step(n_half, 0.5 * dt, out=n_half)
+
+			error = self.error_norm(n, n_full, n_half)
+			if error <= 1.0:
+				n, n_half = n_half, n
+				self.time = t_end if clipped else self.time + dt
+				self.accepted += 1
+			else:
+				self.rejected += 1
+
+			profile = profiling.current()
+			if profile is not None:
+				profile.count("AdaptiveStepper.accepted" if error <= 1.0 else "AdaptiveStepper.rejected")
+
+			if error == 0.0:
+				factor = self.max_factor
+			else:
+				factor = self.safety * error ** (-1.0 / (self.order + 1))
+				factor = min(self.max_factor, max(self.min_factor, factor))
+
+			# a step shortened to land on t_end does not limit the next one
+			if clipped and error <= 1.0:
+				self.dt = min(self.dt_max, max(self.dt, dt * factor))
+			else:
+				self.dt = min(self.dt_max, dt * factor)
+
+		return (n)
+
+
+def evolve_adaptive(energy_edges, energy_loss_rate, tloss_discrete, source, n0, t_end,
+	                rtol=1e-3, atol=0.0, dt=None, dt_max=np.inf):
+	'''
+	Evolve a particle distribution from t = 0 to t_end with error-controlled
+	time steps, see AdaptiveStepper.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of energy bins, len(N)
+
+		energy_loss_rate 	array-like or float
+							dE/dt at edges of energy bins, len (N)
+
+		tloss_discrete 		array-like or float
+							tau_loss in each bin, len (N-1)
+
+		source 				array-like or float
+							source term, len (N-1)
+
+		n0 					array-like
+							len (N-1) array holding initial state
+
+		t_end 				float
+							time to evolve until
+
+		rtol, atol, dt, dt_max
+							passed to AdaptiveStepper
+
+	Returns:
+		n_final 			array-like
+							the distribution at t_end
+
+		stats 				dict
+							number of accepted and rejected steps and the
+							last time-step
+	'''
+	evolver = Evolver(energy_edges, energy_loss_rate, tloss_discrete, source)
+	stepper = AdaptiveStepper(evolver, rtol=rtol, atol=atol, dt=dt, dt_max=dt_max)
+	n = stepper.advance(n0, t_end)
+	return (n, stepper.stats)
+
+
+def iter_snapshots(evolver, n0, t_snap, dt=None, t_start=0.0):
+	'''
+	Evolve a particle distribution and yield it at each snapshot time, so
+	a run with many outputs can be written out or analysed as it goes
+	rather than collected in memory. With an Evolver the steps are at most
+	dt, shortened to land on each snapshot time, and a ScheduledEvolver
+	follows its schedules. With an AdaptiveStepper dt is not used and the
+	stepper chooses the steps.
+
+	The same array is updated in place and yielded each time, so only one
+	distribution is held in memory. Copy it to keep it, or pass the stream
+	to snapshots.write_snapshots.
+
+	Parameters:
+		evolver 			Evolver or AdaptiveStepper
+							evolver for the grid, losses and source
+
+		n0 					array-like
+							len (N-1) array holding initial state
+
+		t_snap 				array-like
+							sorted times at which to yield the distribution
+
+		dt 					float or None
+							largest time-step for an Evolver
+
+		t_start 			float
+							time of the initial state. For an AdaptiveStepper
+							this is the time of the stepper
+
+	Yields:
+		t 					float
+							snapshot time
+
+		n 					array-like
+							the distribution at time t
+	'''
+	n = np.array(n0, dtype=float)
+	adaptive = isinstance(evolver, AdaptiveStepper)
+	scheduled = isinstance(evolver, ScheduledEvolver)
+	t = evolver.time if adaptive else t_start
+
+	if not adaptive and (dt is None or dt <= 0.0):
+		raise ValueError("dt must be positive when stepping with an Evolver")
 
-	dt1 = np.nanmin(n_i[select] / dndt1)
-	dt2 = np.nanmin(n_i[select] / dndt2)
+	for target in t_snap:
+		if target < t:
+			raise ValueError("t_snap must be sorted and after the start time")
 
+		if adaptive:
+			n[...] = evolver.advance(n, target)
+			t = target
 
-	delta_t = 0.4 * np.nanmin( (dt1, dt2) )
+		while t < target:
+			step = min(dt, target - t)
+			if scheduled:
+				evolver.step_at(t, n, step, out=n)
+			else:
+				evolver.step(n, step, out=n)
+			t = target if step < dt else t + step
 
-	return (delta_t)
\ No newline at end of file
+		yield (t, n)
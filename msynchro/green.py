@@ -0,0 +1,94 @@
+from msynchro.evolve import Evolver
+import numpy as np
+
+
+class GreenFunction:
+	'''
+	Response of a particle distribution to injection with a fixed energy
+	spectrum, for losses and escape that do not change with time. The
+	evolution is linear, so once the response to a single step of
+	injection has been evolved for every lag, the distribution for any
+	injection history follows from a convolution in time.
+
+	With injection rate q[m] * source_shape during step m and no particles
+	at t = 0, the distribution after step m is
+
+		n[m] = sum_k q[m - k] * response[k]
+
+	which is identical to stepping particle_evolve with a fixed time-step
+	dt, apart from round-off in the FFT convolution of order 1e-13 of the
+	largest value, and from truncating the response after n_lags steps.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of energy bins, len(N)
+
+		energy_loss_rate 	array-like or float
+							dE/dt at edges of energy bins, len (N)
+
+		tloss_discrete 		array-like or float
+							tau_loss in each bin, len (N-1)
+
+		source_shape 		array-like
+							energy spectrum of the injection, len (N-1), or
+							(n_components, N-1) for several components with
+							independent injection histories
+
+		dt 					float
+							time-step of the injection history
+
+		n_lags 				int
+							number of steps to follow the response for. The
+							response is stored as an (n_lags, n_components,
+							N-1) array, and injection more than n_lags steps
+							in the past is ignored
+	'''
+	def __init__(self, energy_edges, energy_loss_rate, tloss_discrete, source_shape, dt, n_lags):
+
+		self.energy_edges = np.asarray(energy_edges, dtype=float)
+		self.dt = dt
+		self.n_lags = n_lags
+		self.source_shape = np.atleast_2d(np.asarray(source_shape, dtype=float))
+		n_components, nbins = self.source_shape.shape
+
+		evolver = Evolver(self.energy_edges, energy_loss_rate, tloss_discrete, 0.0)
+
+		# evolve one step of injection of each component for every lag
+		self.response = np.empty((n_lags, n_components, nbins))
+		n = self.source_shape * dt
+		for k in range(n_lags):
+			n = evolver.step(n, dt)
+			self.response[k] = n
+
+	def evolve(self, q):
+		'''
+		Get the particle distribution for an injection history.
+
+		Parameters:
+			q 					array-like
+								injection rate at each step, len (n_steps),
+								or (n_steps, n_components) with one column
+								per component of source_shape
+
+		Returns:
+			n 					array-like
+								(n_steps, N-1) array holding the distribution
+								at the end of each step, i.e. at times
+								dt * (1 + arange(n_steps))
+		'''
+		q = np.asarray(q, dtype=float)
+		if q.ndim == 1:
+			q = q[:, np.newaxis]
+		n_steps, n_components = q.shape
+
+		if n_components != self.source_shape.shape[0]:
+			raise ValueError("q has {} components but source_shape has {}".format(
+				n_components, self.source_shape.shape[0]))
+
+		# superpose the responses, one convolution in time per component
+		from scipy import signal
+		n = np.zeros((n_steps, self.response.shape[2]))
+		for c in range(n_components):
+			n += signal.fftconvolve(q[:, c, np.newaxis], self.response[:, c, :], axes=0)[:n_steps]
+
+		return (n)
@@ -0,0 +1,143 @@
+from collections import defaultdict
+import contextlib
+import threading
+import time
+
+_profile = None
+
+
+def current():
+	'''
+	The Profile being recorded, or None when profiling is off. Instrumented
+	functions only do more than this check while profiling is on.
+	'''
+	return (_profile)
+
+
+class Profile:
+	'''
+	Wall time per stage and counters recorded inside a profiling block.
+	Stages and counters are named after the function they are recorded in,
+	e.g. "particle_evolve.setup" for setting up the TDMA coefficients and
+	"particle_evolve.solve" for the C solver. The stages recorded are
+
+		particle_evolve, Evolver 	setup, solve
+		get_dt 						get_dt
+		evolve_until 				solve (the whole C loop)
+		psynch 						bessel or table
+		Ptot 						setup, sum, fft
+
+	and the counters
+
+		particle_evolve, Evolver 	steps, active_bins, limited
+		get_dt 						calls, active_bins
+		evolve_until 				steps
+		AdaptiveStepper 			accepted, rejected
+		psynch 						bessel_evaluations, table_evaluations
+		Ptot 						calls, frequencies
+
+	where active_bins is summed over steps, so active_bins / steps is the
+	mean number of populated bins, limited is the number of steps redone
+	by the positivity limiter, and bessel_evaluations and
+	table_evaluations count the kernel values psynch computed from Bessel
+	functions and looked up in the KernelTable.
+
+	Attributes:
+		times 				dict of seconds spent in each stage
+		calls 				dict of the number of times each stage ran
+		counts 				dict of counters
+	'''
+	def __init__(self):
+		self.times = defaultdict(float)
+		self.calls = defaultdict(int)
+		self.counts = defaultdict(int)
+		self._lock = threading.Lock()
+
+	def lap(self, stage, start):
+		'''
+		Add the time since start to stage, and return the current time to
+		start timing the next stage from
+		'''
+		now = time.perf_counter()
+		with self._lock:
+			self.times[stage] += now - start
+			self.calls[stage] += 1
+		return (now)
+
+	def count(self, name, value=1):
+		'''
+		Add value to the counter name
+		'''
+		with self._lock:
+			self.counts[name] += int(value)
+
+	def merge(self, other):
+		'''
+		Add the times and counts of another Profile to this one
+		'''
+		with self._lock:
+			for stage, seconds in other.times.items():
+				self.times[stage] += seconds
+			for stage, calls in other.calls.items():
+				self.calls[stage] += calls
+			for name, value in other.counts.items():
+				self.counts[name] += value
+
+	def as_dict(self):
+		'''
+		The times, calls and counts as a dict of dicts, e.g. to log as JSON
+		'''
+		return dict(times=dict(self.times), calls=dict(self.calls), counts=dict(self.counts))
+
+	def summary(self):
+		'''
+		Table of the stages, slowest first, followed by the counters
+		'''
+		lines = ["{:32s} {:>12s} {:>10s}".format("stage", "seconds", "calls")]
+		for stage in sorted(self.times, key=self.times.get, reverse=True):
+			lines.append("{:32s} {:12.4e} {:10d}".format(stage, self.times[stage], self.calls[stage]))
+		lines.append("")
+		lines.append("{:32s} {:>12s}".format("counter", "value"))
+		for name in sorted(self.counts):
+			lines.append("{:32s} {:12d}".format(name, self.counts[name]))
+		return ("\n".join(lines))
+
+	def __str__(self):
+		return (self.summary())
+
+
+@contextlib.contextmanager
+def profiling(callback=None):
+	'''
+	Record per-stage wall time and counters for the instrumented functions
+	called inside the block. Profiling is off otherwise, so the functions
+	only check whether it is on.
+
+		with profiling() as profile:
+			n = evolve.evolve_adaptive(...)
+			pnu = Ptot(nus, energies, n, B)
+		print (profile.summary())
+
+	Blocks can be nested, and the inner profile is added to the outer one
+	when it ends.
+
+	Parameters:
+		callback 			callable or None
+							called with the Profile at the end of the block,
+							e.g. to write profile.as_dict() to a log
+
+	Yields:
+		profile 			Profile
+	'''
+	global _profile
+	previous = _profile
+	profile = Profile()
+	_profile = profile
+	try:
+		yield profile
+	finally:
+		_profile = previous
+		if previous is not None:
+			previous.merge(profile)
+		if callback is not None:
+			callback(profile)
@@ -0,0 +1,606 @@
+from msynchro.evolve import Evolver, _inverse_timescale
+import numpy as np
+
+
+def _log_integral(k, u):
+	'''
+	Integral of exp(k u) from 0 to u, (exp(k u) - 1) / k, with the k -> 0
+	limit u
+	'''
+	small = np.fabs(k * u) < 1e-12
+	return (np.where(small, u, np.expm1(k * u) / np.where(small, 1.0, k)))
+
+
+def remap(energy_edges, n, new_edges):
+	'''
+	Conservatively remap a particle distribution onto a new set of energy
+	bins. Within each original bin n is reconstructed as a power law
+	through the bin average, with its index limited (minmod) between the
+	slopes of log n to the neighbouring bins, and the particles in each new
+	bin are the integral of that reconstruction over the overlap. The
+	number of particles in the energy range covered by both grids is
+	conserved exactly, n stays non-negative, and a power law is remapped
+	almost exactly. Each new bin is summed from its own pieces, so bins in
+	a steep tail keep their full relative precision.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of the original energy bins, len(N)
+
+		n 					array-like
+							len (N-1) array holding the distribution, or
+							(n_systems, N-1) stacked distributions
+
+		new_edges 			array-like
+							edges of the new energy bins, len(M). Particles
+							outside energy_edges are taken to be zero
+
+	Returns:
+		n_new 				array-like
+							the distribution in the new bins, len (M-1)
+	'''
+	energy_edges = np.asarray(energy_edges, dtype=float)
+	new_edges = np.asarray(new_edges, dtype=float)
+
+	# split the original bins at every new edge, so each piece lies inside
+	# exactly one original bin and one new bin
+	union = np.union1d(energy_edges, new_edges)
+	j = np.searchsorted(energy_edges, union[:-1], side="right") - 1
+
+	return (_sum_pieces(energy_edges, n, union, j, np.searchsorted(union, new_edges)))
+
+
+def _power_law_index(energy_edges, n, bins):
+	'''
+	Minmod-limited power law index of n in the given bins, the one sided
+	slope at the ends of the grid and zero next to empty bins
+	'''
+	E1 = energy_edges[:-1]
+	E2 = energy_edges[1:]
+	nbins = n.shape[-1]
+	if nbins < 2:
+		return (np.zeros(n.shape[:-1] + bins.shape))
+
+	def between(i):
+		# slope of log n from bin i to bin i + 1, zero unless both are populated
+		lower = n[..., i]
+		upper = n[..., i + 1]
+		dx = 0.5 * np.log(E1[i + 1] * E2[i + 1]) - 0.5 * np.log(E1[i] * E2[i])
+		dlogn = np.log(np.where(upper > 0.0, upper, 1.0)) - np.log(np.where(lower > 0.0, lower, 1.0))
+		return (dlogn / dx * (upper > 0.0) * (lower > 0.0))
+
+	left = between(np.clip(bins - 1, 0, nbins - 2))
+	right = between(np.clip(bins, 0, nbins - 2))
+	index = np.where(left * right > 0.0, np.sign(left) * np.minimum(np.fabs(left), np.fabs(right)), 0.0)
+	index = np.where(bins == 0, right, index)
+	return (np.where(bins == nbins - 1, left, index))
+
+
+def _sum_pieces(energy_edges, n, union, j, new_index):
+	'''
+	remap, given the sorted union of the original and new edges, the
+	original bin j holding each piece between them, outside [0, N-1) for
+	pieces outside the original grid, and the position of each new edge in
+	the union
+	'''
+	n = np.asarray(n, dtype=float)
+	E1 = energy_edges[:-1]
+	E2 = energy_edges[1:]
+	nbins = len(E1)
+	a = union[:-1]
+	b = union[1:]
+	inside = (j >= 0) * (j < nbins)
+	j = np.clip(j, 0, nbins - 1)
+
+	# a piece covering a whole original bin holds all its particles
+	pieces = n[..., j] * (E2[j] - E1[j])
+
+	# otherwise the fraction of the particles in bin j between a and b for
+	# n ~ E^index, integrating E^(index + 1) over u = ln(E / E1)
+	split = np.flatnonzero((a != E1[j]) | (b != E2[j]))
+	if len(split) > 0:
+		js = j[split]
+		k = _power_law_index(energy_edges, n, js) + 1.0
+		width = _log_integral(k, np.log(E2[js] / E1[js]))
+		pieces[..., split] = pieces[..., split] * (
+			_log_integral(k, np.log(b[split] / E1[js])) - _log_integral(k, np.log(a[split] / E1[js]))) / width
+	pieces *= inside
+
+	# sum the pieces in each new bin
+	number = np.add.reduceat(pieces[..., :new_index[-1]], new_index[:-1], axis=-1)
+
+	return (number / np.diff(union[new_index]))
+
+
+def _spread_down(widths, reach):
+	'''
+	Give each block the smallest width of itself and the blocks above it
+	whose reach extends down to it
+	'''
+	nblocks = len(widths)
+	spread = np.array(widths)
+	for width in np.unique(widths)[:-1]:
+		# count the blocks of at most this width reaching each block
+		index = np.flatnonzero(widths <= width)
+		count = (np.bincount(np.maximum(index - reach[index], 0), minlength=nblocks + 1)
+		         - np.bincount(index + 1, minlength=nblocks + 1))
+		covered = np.cumsum(count)[:-1] > 0
+		spread = np.where(covered, np.minimum(spread, width), spread)
+	return (spread)
+
+
+class AdaptiveMesh:
+	'''
+	Evolve particle distributions on an adaptive energy grid whose edges are
+	a subset of a fine base grid. Bins where the distribution is empty or a
+	smooth power law are merged into blocks of up to max_merge base bins,
+	while bins near sharp features, such as cooling breaks, cutoffs and
+	injection peaks, are kept at the base resolution. Distributions are
+	moved between meshes with remap, so the number of particles is
+	conserved, and steps on the current mesh are the same as Evolver.step
+	with the loss rates sampled at the kept edges. On the base mesh the
+	steps are identical to particle_evolve.
+
+	The base grid is split into aligned blocks of max_merge bins, and each
+	block is divided into mesh bins of a power of two base bins. A block
+	is refined to the base resolution when the curvature of log n against
+	log E, measured from the block averages, is large enough that
+	representing the block by its average would be wrong by more than
+	rtol, or when it holds an edge of the populated part of the grid or a
+	feature of the source. Elsewhere the upwind loss term, which is first
+	order in the bin width, sets how wide the mesh bins can be where
+	particles are cooling through them, see merge_widths. Refined regions
+	are padded by buffer blocks on either side, and extended down to where
+	particles cool to before the mesh is next adapted.
+
+	The kept edges and the distribution on them can be passed straight to
+	Ptot, so the synchrotron spectrum is also computed on the reduced grid.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of the base energy bins, len(N)
+
+		energy_loss_rate 	array-like or float
+							dE/dt at edges of the base bins, len (N)
+
+		tloss_discrete 		array-like or float
+							tau_loss in each base bin, len (N-1)
+
+		source 				array-like or float
+							source term on the base bins, len (N-1)
+
+		rtol 				float
+							allowed relative error in n from merging bins,
+							compared to evolving on the base grid
+
+		max_merge 			int
+							largest number of base bins in one mesh bin
+
+		buffer 				int
+							number of blocks to refine either side of each
+							refined block
+
+		relative_threshold 	float
+							bins below this fraction of the maximum are
+							treated as empty
+
+		scheme, positive 	passed to Evolver
+	'''
+	def __init__(self, energy_edges, energy_loss_rate, tloss_discrete, source, rtol=1e-2,
+		         max_merge=16, buffer=1, relative_threshold=1e-15, scheme="implicit",
+		         positive=False):
+
+		self.base_edges = np.asarray(energy_edges, dtype=float)
+		self.energy_loss_rate = energy_loss_rate
+		self.tloss_discrete = tloss_discrete
+		self.source = source
+		self.rtol = rtol
+		self.max_merge = int(max_merge)
+		self.buffer = int(buffer)
+		self.relative_threshold = relative_threshold
+		self.scheme = scheme
+		self.positive = positive
+
+		if self.max_merge < 1:
+			raise ValueError("max_merge must be at least 1")
+
+		# indices of the base edges bounding each aligned block of max_merge
+		# base bins, the largest a mesh bin can be
+		nbase = len(self.base_edges) - 1
+		self._block_index = np.append(np.arange(0, nbase, self.max_merge), nbase)
+		self._block_edges = self.base_edges[self._block_index]
+		nblocks = len(self._block_index) - 1
+
+		# the inputs do not depend on the mesh, so they are set up once, with
+		# the escape rates and source as numbers of particles per base bin
+		# that _build sums over each mesh bin
+		base_widths = np.diff(self.base_edges)
+		self._loss = None
+		if not (energy_loss_rate is None or np.isscalar(energy_loss_rate)):
+			self._loss = np.asarray(energy_loss_rate, dtype=float)
+		escape_number = _inverse_timescale(tloss_discrete, nbase) * base_widths
+		self._escape_number = None
+		if not (tloss_discrete is None or np.isscalar(tloss_discrete)):
+			self._escape_number = escape_number
+		self._source_number = None
+		if not np.isscalar(source):
+			self._source_number = np.broadcast_to(np.asarray(source, dtype=float), (nbase,)) * base_widths
+
+		# loss rate at the lower edge of each block, and the mean escape rate
+		scalar_loss = self._loss is None
+		self._log_block = np.diff(np.log(self._block_edges))
+		if scalar_loss:
+			edot = np.zeros(nblocks) if energy_loss_rate is None else np.full(nblocks, float(energy_loss_rate))
+		else:
+			edot = np.fabs(self._loss[self._block_index[:-1]])
+		inv_tloss = np.add.reduceat(escape_number, self._block_index[:-1]) / np.diff(self._block_edges)
+		self._cooling = edot > 0.0
+
+		# for every power of two width, the base bins of a block having about
+		# the same width in log E, the fraction of the particles leaving a
+		# mesh bin that cool out of it rather than escape, see merge_widths.
+		# A scalar loss rate is already a rate out of each bin
+		# A scalar loss rate is already a rate out of each bin. Each is an
+		# (n_candidates, nblocks) array
+		log_width = self._log_block / np.diff(self._block_index)
+		candidates = [w for w in 2 ** np.arange(int(np.log2(self.max_merge)) + 1) if w < self.max_merge]
+		self._candidates = np.array(candidates + [self.max_merge])
+		self._u = self._candidates[:, np.newaxis] * log_width
+		self._expm1_u = np.expm1(self._u)
+		rate = np.broadcast_to(edot if scalar_loss else edot / (self._block_edges[:-1] * self._expm1_u), self._u.shape)
+		self._weight = np.zeros(self._u.shape)
+		np.divide(rate, rate + inv_tloss, out=self._weight, where=np.broadcast_to(self._cooling, self._u.shape))
+
+		# the edges each width keeps in a block, by width
+		offset = np.arange(self.max_merge)
+		self._patterns = np.zeros((self.max_merge + 1, self.max_merge), dtype=bool)
+		self._patterns[1:] = offset % np.arange(1, self.max_merge + 1)[:, np.newaxis] == 0
+
+		# time to cool from the bottom of the grid to each block edge, taking
+		# the faster of the loss rates at the edges of each block, and the
+		# highest block at or below each block where the losses stop
+		if scalar_loss:
+			self._scalar_rate = edot
+		else:
+			rate = np.maximum(edot, np.fabs(self._loss[self._block_index[1:]]))
+			crossing = np.zeros(nblocks)
+			np.divide(np.diff(self._block_edges), rate, out=crossing, where=(rate > 0.0))
+			self._cooling_time = np.append(0.0, np.cumsum(crossing))
+			self._stop = np.maximum.accumulate(np.where(rate > 0.0, 0, np.arange(nblocks)))
+
+		# start from the base mesh
+		self.keep = np.ones(len(self.base_edges), dtype=bool)
+		self._widths = np.ones(nblocks, dtype=int)
+		self._build()
+
+		# features of the source need the base resolution from the start,
+		# before any particles have been injected there
+		self._source_flags = np.zeros(nblocks, dtype=bool)
+		if self._source_number is not None:
+			self._source_flags = self.refine_blocks(np.broadcast_to(source, (nbase,)))
+
+	@property
+	def edges(self):
+		'''
+		edges of the current mesh bins
+		'''
+		return (self.base_edges[self.keep])
+
+	@property
+	def nbins(self):
+		'''
+		number of bins in the current mesh
+		'''
+		return (self.evolver.nbins)
+
+	def _build(self):
+		'''
+		Set up the Evolver for the current mesh
+		'''
+		edges = self.edges
+		first = np.flatnonzero(self.keep)[:-1]
+
+		# width and block of each mesh bin, mesh bins never straddle
+		# blocks, and the number of mesh bins in each block
+		self._mesh_widths = np.diff(edges)
+		self._mesh_block = first // self.max_merge
+		self._mesh_count = np.bincount(self._mesh_block, minlength=len(self._block_index) - 1)
+
+		# loss rates are defined at edges, so are sampled at the kept ones
+		loss = self.energy_loss_rate
+		if self._loss is not None:
+			loss = self._loss[self.keep]
+
+		# escape rates and the source are averaged over each mesh bin, which
+		# is what remap gives for bins made of whole base bins
+		tloss = self.tloss_discrete
+		if self._escape_number is not None:
+			inv_tloss = np.add.reduceat(self._escape_number, first) / self._mesh_widths
+			tloss = np.zeros_like(inv_tloss)
+			np.divide(1.0, inv_tloss, out=tloss, where=(inv_tloss != 0.0))
+
+		source = self.source
+		if self._source_number is not None:
+			source = np.add.reduceat(self._source_number, first) / self._mesh_widths
+
+		self.evolver = Evolver(edges, loss, tloss, source, scheme=self.scheme,
+		                       positive=self.positive)
+
+	def _block_profile(self, n):
+		'''
+		Block each mesh bin lies in and whether it is populated, and for
+		each block whether all its bins are populated, and the slope and
+		curvature of log n against log E measured from the block averages
+		'''
+		nblocks = len(self._block_index) - 1
+		block = self._mesh_block
+		populated = n > self.relative_threshold * np.max(n)
+
+		# block averages, so they do not depend on how blocks are divided
+		block_edges = self._block_edges
+		number = np.bincount(block, weights=n * self._mesh_widths, minlength=nblocks)
+		full = np.bincount(block, weights=populated, minlength=nblocks) == self._mesh_count
+		logn = np.log(np.where(full, number, 1.0) / np.diff(block_edges))
+		x = 0.5 * np.log(block_edges[:-1] * block_edges[1:])
+
+		# slope between neighbouring blocks, averaged either side and one
+		# sided at the ends of the populated region
+		valid = full[1:] * full[:-1]
+		between = np.where(valid, np.diff(logn) / np.diff(x), 0.0)
+		total = np.zeros(nblocks)
+		count = np.zeros(nblocks)
+		total[1:] += between
+		total[:-1] += between
+		count[1:] += valid
+		count[:-1] += valid
+		slope = total / np.maximum(count, 1)
+
+		# second derivative from the deviation of each block from the line
+		# through its neighbours
+		curvature = np.zeros(nblocks)
+		h_left = x[1:-1] - x[:-2]
+		h_right = x[2:] - x[1:-1]
+		line = (h_right * logn[:-2] + h_left * logn[2:]) / (h_left + h_right)
+		interior = full[:-2] * full[1:-1] * full[2:]
+		curvature[1:-1] = interior * 2.0 * np.fabs(logn[1:-1] - line) / (h_left * h_right)
+
+		return (block, populated, full, slope, curvature)
+
+	def refine_blocks(self, n):
+		'''
+		Find the blocks of max_merge base bins that need the base resolution
+		because of the curvature of n, an edge of the populated region, or
+		the same features of the source.
+
+		Parameters:
+			n 					array-like
+								distribution on the current mesh
+
+		Returns:
+			flags 				array-like
+								boolean array with one value per block, True
+								where the block should be refined
+		'''
+		n = np.asarray(n, dtype=float)
+		if len(n) == 0 or np.max(n) <= 0.0:
+			return (self._source_flags.copy())
+		return (self._refine(self._block_profile(n)))
+
+	def _refine(self, profile):
+		'''
+		refine_blocks for a populated distribution, from its _block_profile
+		'''
+		block, populated, full, slope, curvature = profile
+		flags = np.zeros(len(self._block_index) - 1, dtype=bool)
+
+		# refine either side of the edges of the populated region
+		change = populated[1:] != populated[:-1]
+		flags[block[:-1][change]] = True
+		flags[block[1:][change]] = True
+
+		# error from averaging over the block
+		error = curvature * self._log_block ** 2 / 8.0
+		flags |= error > self.rtol
+
+		# pad the refined regions
+		if self.buffer > 0:
+			flags = np.convolve(flags, np.ones(2 * self.buffer + 1), mode="same") > 0
+
+		return (flags | self._source_flags)
+
+	def merge_widths(self, n, horizon=0.0):
+		'''
+		Find the number of base bins to merge into each mesh bin of every
+		block. Blocks flagged by refine_blocks get the base resolution. In
+		the others the upwind loss term leaves a merged bin at roughly the
+		value of n at its lower edge, as particles cool out through that
+		edge, rather than its average. For n ~ E^s over a mesh bin whose
+		upper edge is r times its lower edge the relative error is
+
+			|(r^(s+1) - 1) / ((s+1) (r-1)) - 1|,
+
+		about |s| ln(r) / 2. The same first order error smears features as
+		they cool through the mesh, such as a moving cooling break, which
+		adds about ln(r) / 2 times the curvature of log n. Escape at a rate
+		1/tau competes with cooling out of the bin at a rate
+		A = Edot / Delta E, and lets n relax to its local value instead, so
+		the error is weighted by A / (A + 1/tau). The width is the largest
+		power of two up to max_merge keeping this below rtol, with s and
+		the curvature measured from the block averages. Where there are no
+		energy losses the blocks are merged whole.
+
+		Features cool to lower energies between calls to adapt, so each
+		width is also applied to the blocks below it that particles reach
+		within twice horizon, which leaves room for the implicit steps
+		smearing a cooling front ahead of the characteristics.
+
+		Parameters:
+			n 					array-like
+								distribution on the current mesh
+
+			horizon 			float
+								time until the mesh is next adapted
+
+		Returns:
+			widths 				array-like
+								integer array with one value per block
+		'''
+		n = np.asarray(n, dtype=float)
+		widths = np.full(len(self._block_index) - 1, self.max_merge)
+		if len(n) == 0 or np.max(n) <= 0.0:
+			widths[self._source_flags] = 1
+		else:
+			profile = self._block_profile(n)
+			block, populated, full, slope, curvature = profile
+
+			# try every power of two and keep the widest within rtol
+			u = self._u
+			bias = np.fabs(_log_integral(slope + 1.0, u) / self._expm1_u - 1.0)
+			accurate = self._weight * (bias + 0.5 * u * curvature) <= self.rtol
+			widest = len(u) - 1 - np.argmax(accurate[::-1], axis=0)
+			merge = self._cooling * full
+			widths = np.where(merge, np.where(np.any(accurate, axis=0), self._candidates[widest], 1), self.max_merge)
+
+			widths[self._refine(profile)] = 1
+
+		# pad as refine_blocks does, each block taking the narrowest width
+		# of its neighbours
+		if self.buffer > 0:
+			padded = np.pad(widths, self.buffer, mode="edge")
+			windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * self.buffer + 1)
+			widths = np.min(windows, axis=1)
+
+		# number of blocks particles cool through within horizon. The
+		# implicit steps smear a cooling front ahead of its characteristics,
+		# so the widths are carried twice as far
+		if horizon > 0.0:
+			reach_time = 2.0 * horizon
+			if self._loss is None:
+				# a scalar loss rate moves particles about one mesh bin per 1/rate
+				reach = np.minimum(np.ceil(reach_time * self._scalar_rate), len(widths))
+			else:
+				# from the top of each block to where the particles are after
+				# cooling for reach_time
+				time = self._cooling_time
+				lowest = np.searchsorted(time, time[1:] - reach_time, side="right") - 1
+				reach = np.arange(len(widths)) - np.maximum(lowest, self._stop)
+			widths = _spread_down(widths, reach.astype(int))
+
+		return (widths)
+
+	def adapt(self, n, horizon=0.0):
+		'''
+		Remesh for the distribution n and remap n onto the new mesh.
+
+		Parameters:
+			n 					array-like
+								distribution on the current mesh
+
+			horizon 			float
+								time until the mesh is next adapted, so the
+								refined regions cover where features cool to
+								by then, see merge_widths
+
+		Returns:
+			n_new 				array-like
+								distribution on the new mesh, which is n
+								itself if the mesh does not change
+		'''
+		widths = self.merge_widths(n, horizon=horizon)
+		if np.array_equal(widths, self._widths):
+			return (np.asarray(n, dtype=float))
+		self._widths = widths
+
+		# each block keeps its first edge and every widths-th edge after it
+		keep = np.ones(len(self.base_edges), dtype=bool)
+		keep[:-1] = self._patterns[widths].ravel()[:len(keep) - 1]
+
+		if np.array_equal(keep, self.keep):
+			return (np.asarray(n, dtype=float))
+
+		old_keep = self.keep
+		self.keep = keep
+		self._build()
+		return (self._remap(n, old_keep, keep))
+
+	def step(self, n_i, dt, out=None):
+		'''
+		Evolve a distribution on the current mesh for one time step, see
+		Evolver.step.
+		'''
+		return (self.evolver.step(n_i, dt, out=out))
+
+	def _remap(self, n, keep, new_keep):
+		'''
+		remap n between the meshes of the base edges where keep and new_keep
+		are True, finding the pieces from the masks instead of sorting edges
+		'''
+		union = keep | new_keep
+		j = np.cumsum(keep[union][:-1]) - 1
+		return (_sum_pieces(self.base_edges[keep], n, self.base_edges[union], j, np.flatnonzero(new_keep[union])))
+
+	def to_base(self, n):
+		'''
+		Remap a distribution on the current mesh onto the base grid
+		'''
+		return (self._remap(n, self.keep, np.ones_like(self.keep)))
+
+	def from_base(self, n):
+		'''
+		Remap a distribution on the base grid onto the current mesh
+		'''
+		return (self._remap(n, np.ones_like(self.keep), self.keep))
+
+
+def evolve_remeshed(energy_edges, energy_loss_rate, tloss_discrete, source, n0, dt, nsteps,
+	                remesh_every=100, **kwargs):
+	'''
+	Evolve a particle distribution for nsteps fixed time steps on an
+	AdaptiveMesh, remeshing every remesh_every steps with a horizon of
+	remesh_every * dt.
+
+	Parameters:
+		energy_edges 		array-like
+							edges of the base energy bins, len(N)
+
+		energy_loss_rate 	array-like or float
+							dE/dt at edges of energy bins, len (N)
+
+		tloss_discrete 		array-like or float
+							tau_loss in each bin, len (N-1)
+
+		source 				array-like or float
+							source term, len (N-1)
+
+		n0 					array-like
+							len (N-1) array holding initial state on the
+							base grid
+
+		dt 					float
+							time-step
+
+		nsteps 				int
+							number of steps
+
+		remesh_every 		int
+							number of steps between calls to adapt
+
+		**kwargs 			passed to AdaptiveMesh
+
+	Returns:
+		n_final 			array-like
+							the distribution after nsteps, remapped onto the
+							base grid
+
+		mesh 				AdaptiveMesh
+							the mesh, with the edges used for the last steps
+	'''
+	mesh = AdaptiveMesh(energy_edges, energy_loss_rate, tloss_discrete, source, **kwargs)
+	horizon = remesh_every * dt
+	n = mesh.adapt(np.array(n0, dtype=float), horizon=horizon)
+	for i in range(nsteps):
+		n = mesh.step(n, dt, out=n)
+		if (i + 1) % remesh_every == 0 and i + 1 < nsteps:
+			n = mesh.adapt(n, horizon=horizon)
+
+	return (mesh.to_base(n), mesh)
@@ -0,0 +1,225 @@
+from msynchro.msynchro import SynchrotronOperator
+import numpy as np
+import json
+import os
+
+
+def metadata_name(fname):
+	'''
+	Name of the sidecar file holding the times, energy grid and metadata
+	of the snapshot file fname
+	'''
+	return (os.path.splitext(fname)[0] + "_meta.npz")
+
+
+class SnapshotWriter:
+	'''
+	Write particle distributions into a preallocated, memory-mapped .npy
+	file of shape (n_snapshots, N-1), so only the snapshot being written is
+	held in memory however long the run is. The data file is a standard
+	.npy file that np.load can memory-map. The snapshot times, the energy
+	grid, the number of snapshots written so far and a dict of metadata are
+	kept in a small sidecar .npz file (see metadata_name), which is updated
+	on flush and on close. Use load_snapshots to read both back.
+
+		with SnapshotWriter("run.npy", len(t_snap), energy_edges) as writer:
+			for t, n in evolve.iter_snapshots(evolver, n0, t_snap, dt):
+				writer.write(t, n)
+
+	Parameters:
+		fname 				str
+							name of the .npy file to create
+
+		n_snapshots 		int
+							number of snapshots to allocate space for
+
+		energy_edges 		array-like
+							edges of energy bins, len(N)
+
+		metadata 			dict or None
+							JSON serialisable description of the run, e.g.
+							the magnetic field and injection parameters
+
+		flush_every 		int
+							number of snapshots between flushes to disk
+	'''
+	def __init__(self, fname, n_snapshots, energy_edges, metadata=None, flush_every=100):
+
+		self.fname = fname
+		self.energy_edges = np.asarray(energy_edges, dtype=float)
+		self.metadata = dict() if metadata is None else dict(metadata)
+		self.flush_every = flush_every
+
+		self.data = np.lib.format.open_memmap(fname, mode="w+", dtype=np.float64,
+		                                      shape=(n_snapshots, len(self.energy_edges) - 1))
+		self.times = np.full(n_snapshots, np.nan)
+		self.count = 0
+		self._write_metadata()
+
+	def __enter__(self):
+		return (self)
+
+	def __exit__(self, *args):
+		self.close()
+
+	def _write_metadata(self):
+		np.savez(metadata_name(self.fname), times=self.times, energy_edges=self.energy_edges,
+		         count=self.count, metadata=json.dumps(self.metadata))
+
+	def write(self, t, n):
+		'''
+		Write the distribution n at time t as the next snapshot.
+		'''
+		if self.count >= len(self.times):
+			raise IndexError("all {} snapshots have been written".format(len(self.times)))
+
+		self.data[self.count] = n
+		self.times[self.count] = t
+		self.count += 1
+
+		if self.count % self.flush_every == 0:
+			self.flush()
+
+	def flush(self):
+		'''
+		Write the snapshots and the sidecar file to disk
+		'''
+		self.data.flush()
+		self._write_metadata()
+
+	def close(self):
+		'''
+		Flush and release the memory map
+		'''
+		if self.data is not None:
+			self.flush()
+			self.data = None
+
+
+def write_snapshots(fname, stream, n_snapshots, energy_edges, metadata=None):
+	'''
+	Write a stream of snapshots, such as evolve.iter_snapshots, to a
+	memory-mapped .npy file with SnapshotWriter.
+
+	Parameters:
+		fname 				str
+							name of the .npy file to create
+
+		stream 				iterable
+							(t, n) pairs to write
+
+		n_snapshots 		int
+							number of snapshots in the stream
+
+		energy_edges 		array-like
+							edges of energy bins, len(N)
+
+		metadata 			dict or None
+							JSON serialisable description of the run
+
+	Returns:
+		snapshots 			Snapshots
+							the written snapshots, memory-mapped read only
+	'''
+	with SnapshotWriter(fname, n_snapshots, energy_edges, metadata=metadata) as writer:
+		for t, n in stream:
+			writer.write(t, n)
+
+	return (load_snapshots(fname))
+
+
+class Snapshots:
+	'''
+	Snapshots written by SnapshotWriter, read lazily from a memory-mapped
+	.npy file. Indexing and iterating only read the snapshots used, and
+	spectra computes synchrotron spectra in chunks, so files much larger
+	than memory can be analysed. Use load_snapshots to create.
+
+	Attributes:
+		data 				memmap of shape (len(self), N-1)
+		times 				snapshot times
+		energy_edges 		edges of energy bins, len(N)
+		energies 			bin centres, len (N-1)
+		metadata 			dict of metadata
+	'''
+	def __init__(self, fname, mmap_mode="r"):
+
+		with np.load(metadata_name(fname)) as meta:
+			count = int(meta["count"])
+			self.times = meta["times"][:count]
+			self.energy_edges = meta["energy_edges"]
+			self.metadata = json.loads(str(meta["metadata"]))
+
+		self.fname = fname
+		self.data = np.load(fname, mmap_mode=mmap_mode)[:count]
+		self.energies = 0.5 * (self.energy_edges[1:] + self.energy_edges[:-1])
+
+	def __len__(self):
+		return (len(self.times))
+
+	def __getitem__(self, index):
+		return (self.data[index])
+
+	def __iter__(self):
+		'''
+		Iterate over (t, n) pairs, reading one snapshot at a time
+		'''
+		for i in range(len(self)):
+			yield (self.times[i], np.asarray(self.data[i]))
+
+	def chunks(self, chunk_size=256):
+		'''
+		Iterate over (times, n) blocks of up to chunk_size snapshots
+		'''
+		for start in range(0, len(self), chunk_size):
+			yield (self.times[start:start + chunk_size],
+			       np.asarray(self.data[start:start + chunk_size]))
+
+	def spectra(self, nus, B, chunk_size=256, tabulated=False):
+		'''
+		Get the synchrotron spectrum of every snapshot, reading chunk_size
+		snapshots at a time. The same as Ptot(nus, energies, n, B) for each
+		snapshot n, with the energies at the bin centres.
+
+		Parameters:
+			nus 				array-like
+								1D array of frequencies in Hz
+
+			B 					float
+								magnetic field in Gauss
+
+			chunk_size 			int
+								number of snapshots read at once
+
+			tabulated 			bool
+								use the tabulated kernel in psynch
+
+		Returns:
+			pnus 				array-like
+								spectra of shape (len(self), len(nus))
+		'''
+		operator = SynchrotronOperator(nus, self.energies, B, tabulated=tabulated)
+		pnus = np.empty((len(self), len(operator.nus)))
+		for start in range(0, len(self), chunk_size):
+			pnus[start:start + chunk_size] = operator.spectrum(
+				np.asarray(self.data[start:start + chunk_size]))
+
+		return (pnus)
+
+
+def load_snapshots(fname, mmap_mode="r"):
+	'''
+	Open snapshots written by SnapshotWriter.
+
+	Parameters:
+		fname 				str
+							name of the .npy file
+
+		mmap_mode 			str
+							memory-map mode passed to np.load
+
+	Returns:
+		snapshots 			Snapshots
+							the snapshots, read lazily from disk
+	'''
+	return (Snapshots(fname, mmap_mode=mmap_mode))
@@ -0,0 +1,204 @@
+from msynchro.msynchro import KernelTable, get_kernel_table
+from multiprocessing import shared_memory
+import msynchro.msynchro
+import multiprocessing
+import itertools
+import numpy as np
+
+
+class SharedArrays:
+	'''
+	Named numpy arrays held in multiprocessing.shared_memory blocks. When a
+	SharedArrays is sent to another process only the names, shapes and
+	dtypes of the blocks are pickled, and the receiving process maps the
+	same memory, so large grids and loss arrays are never copied. The
+	process that created the arrays frees the memory on close, or on
+	leaving a with block.
+
+	Parameters:
+		arrays 				dict
+							arrays to copy into shared memory
+	'''
+	def __init__(self, arrays):
+		self.specs = {}
+		self._blocks = {}
+		self._owner = True
+		for name, array in arrays.items():
+			array = np.ascontiguousarray(array)
+			block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+			np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+			self._blocks[name] = block
+			self.specs[name] = (block.name, array.shape, array.dtype.str)
+
+	def __getstate__(self):
+		return (self.specs)
+
+	def __setstate__(self, specs):
+		self.specs = specs
+		self._owner = False
+		self._blocks = {name: shared_memory.SharedMemory(name=spec[0])
+		                for name, spec in specs.items()}
+
+	def __enter__(self):
+		return (self)
+
+	def __exit__(self, *args):
+		self.close()
+
+	def __contains__(self, name):
+		return (name in self.specs)
+
+	def __getitem__(self, name):
+		'''
+		Array view of the shared block called name
+		'''
+		_, shape, dtype = self.specs[name]
+		return (np.ndarray(shape, dtype=dtype, buffer=self._blocks[name].buf))
+
+	def keys(self):
+		return (self.specs.keys())
+
+	def close(self):
+		'''
+		Detach from the shared memory, and free it in the creating process
+		'''
+		for block in self._blocks.values():
+			block.close()
+			if self._owner:
+				block.unlink()
+		self._blocks = {}
+
+
+class _ReadOnly:
+	'''
+	Read-only array views of a SharedArrays, as passed to sweep functions
+	'''
+	def __init__(self, shared):
+		self._shared = shared
+
+	def __contains__(self, name):
+		return (name in self._shared)
+
+	def __getitem__(self, name):
+		array = self._shared[name]
+		array.flags.writeable = False
+		return (array)
+
+	def keys(self):
+		return (self._shared.keys())
+
+
+# state of each worker process, set once by _init_worker
+_worker = {}
+
+
+def _init_worker(func, inputs, outputs):
+	_worker["func"] = func
+	_worker["inputs"] = inputs
+	_worker["shared"] = _ReadOnly(inputs)
+	_worker["outputs"] = outputs
+
+	# install the parent's kernel table rather than building one per worker
+	if "_kernel_log_t" in inputs:
+		table = KernelTable.__new__(KernelTable)
+		table.log_t = inputs["_kernel_log_t"]
+		table.log_g = inputs["_kernel_log_g"]
+		msynchro.msynchro._kernel_table = table
+
+
+def _run(task):
+	index, params = task
+	_worker["outputs"]["results"][index] = _worker["func"](params, _worker["shared"])
+	return (index)
+
+
+def parameter_grid(**axes):
+	'''
+	Every combination of the values of each parameter, as a list of dicts
+	with the last parameter varying fastest, so the results of sweep can be
+	reshaped to (len(axis_1), len(axis_2), ...) + result_shape.
+
+		params = parameter_grid(B=B_values, index=[2.0, 2.5], tesc=tesc_values)
+
+	Parameters:
+		**axes 				sequences of values for each parameter
+
+	Returns:
+		params 				list of dict
+	'''
+	names = list(axes)
+	return ([dict(zip(names, values)) for values in itertools.product(*axes.values())])
+
+
+def sweep(func, params, shared=None, result_shape=(), processes=None, kernel_table=False):
+	'''
+	Run func(params, shared) for every set of parameters on a pool of
+	processes and gather the results into one array. The shared input
+	arrays, e.g. energy edges, loss profiles and the frequency grid, are
+	placed in shared memory once rather than pickled for every run, and
+	each worker writes its result straight into a shared output array.
+	Runs are handed out one at a time to whichever worker is free, so
+	workers that finish quick runs take on more of them and all cores stay
+	busy until the queue is empty.
+
+		def run(params, shared):
+			n = evolve.evolve_until(shared["energy_edges"], ...)
+			return Ptot(shared["nus"], energies, n, params["B"])
+
+		spectra = sweep(run, parameter_grid(B=B_values), dict(energy_edges=edges, nus=nus),
+		                result_shape=len(nus))
+
+	Parameters:
+		func 				callable
+							function of a parameter dict and a read-only
+							mapping of the shared arrays, returning an array
+							of shape result_shape. It must be defined at the
+							top level of a module so it can be pickled
+
+		params 				sequence of dict
+							parameters of each run, e.g. from parameter_grid
+
+		shared 				dict or None
+							arrays to place in shared memory
+
+		result_shape 		int or tuple
+							shape of the result of one run
+
+		processes 			int or None
+							number of worker processes, defaults to the
+							number of CPUs. With processes=1 the runs are
+							done in this process, which helps debugging
+
+		kernel_table 		bool
+							share the KernelTable used by psynch with
+							tabulated=True, so it is built once here
+							rather than in every worker
+
+	Returns:
+		results 			array-like
+							array of shape (len(params),) + result_shape
+	'''
+	params = list(params)
+	if np.isscalar(result_shape):
+		result_shape = (result_shape,)
+
+	arrays = dict() if shared is None else dict(shared)
+	if kernel_table:
+		table = get_kernel_table()
+		arrays.update(_kernel_log_t=table.log_t, _kernel_log_g=table.log_g)
+
+	output = np.full((len(params),) + tuple(result_shape), np.nan)
+	with SharedArrays(arrays) as inputs, SharedArrays(dict(results=output)) as outputs:
+		if processes == 1:
+			view = _ReadOnly(inputs)
+			for index, p in enumerate(params):
+				outputs["results"][index] = func(p, view)
+		else:
+			with multiprocessing.Pool(processes, initializer=_init_worker,
+			                          initargs=(func, inputs, outputs)) as pool:
+				for index in pool.imap_unordered(_run, enumerate(params), chunksize=1):
+					pass
+
+		output[...] = outputs["results"]
+
+	return (output)
@@ -1,45 +1,217 @@
 /* ///////////////////////////////////////////////////////////////////// */
-/*! 
-  \file  
+/*!
+  \file
   \brief Tridiagonal matrix algorithm
 */
 /* ///////////////////////////////////////////////////////////////////// */
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 #include "Python.h"
 #include <numpy/arrayobject.h>
 #include <stdlib.h>
 
 double *pyvector_to_Carrayptrs (PyArrayObject * arrayin);
 
-static PyObject *
-TDMASolver (PyObject * self, PyObject * args)
+/* Solve a single tridiagonal system of length npoints. bwork and dwork are
+   scratch arrays of length npoints, so the inputs are left untouched. */
+static void
+tdma_solve (const double *ac, const double *bc, const double *cc,
+            const double *dc, double *xc, double *bcnew, double *dcnew,
+            npy_intp npoints)
 {
   double mc;
-  double *ac, *bc, *cc, *dc, *xc;
-  double *acnew, *bcnew, *ccnew, *dcnew;
-  int i, npoints;
+  npy_intp i;
 
-  /* Variables for calling from Python */
-  PyArrayObject *a, *b, *c, *d;
-  PyObject *out_array;
+  for (i = 0; i < npoints; i++)
+  {
+    bcnew[i] = bc[i];
+    dcnew[i] = dc[i];
+  }
+
+  for (i = 1; i < npoints; i++)
+  {
+    mc = ac[i - 1] / bcnew[i - 1];
+    bcnew[i] = bcnew[i] - mc * cc[i - 1];
+    dcnew[i] = dcnew[i] - mc * dcnew[i - 1];
+  }
+
+  /* set boundary condition */
+  xc[npoints - 1] = dcnew[npoints - 1] / bcnew[npoints - 1];
+
+  /* second sweep */
+  for (i = npoints - 2; i > -1; i--)
+  {
+    xc[i] = (dcnew[i] - cc[i] * xc[i + 1]) / bcnew[i];
+  }
+}
+
+/* Back substitution for an upper bidiagonal system, i.e. a tridiagonal
+   system with a == 0. Every bin above the highest non-zero entry of d has a
+   zero solution, so the sweep starts from there. For pure cooling this is
+   the highest populated bin. Returns the number of bins in the active
+   window. The solution is identical to tdma_solve with a == 0. */
+static npy_intp
+bidiagonal_solve (const double *bc, const double *cc, const double *dc,
+                  double *xc, npy_intp npoints)
+{
+  npy_intp i, top;
+
+  top = npoints - 1;
+  while (top > 0 && dc[top] == 0.0)
+  {
+    xc[top] = 0.0;
+    top--;
+  }
+
+  xc[top] = dc[top] / bc[top];
+  for (i = top - 1; i > -1; i--)
+  {
+    xc[i] = (dc[i] - cc[i] * xc[i + 1]) / bc[i];
+  }
+  return top + 1;
+}
+
+/* Convert an argument to a contiguous 1D double array, checking its length
+   unless npoints is negative */
+static PyArrayObject *
+vector_argument (PyObject * obj, npy_intp npoints, const char *name)
+{
+  PyArrayObject *arr;
 
-  /*  parse single numpy array argument with a series of double variables after it */
-  if (!PyArg_ParseTuple
-      (args, "O!O!O!O!", &PyArray_Type, &a, &PyArray_Type, &b,
-       &PyArray_Type, &c, &PyArray_Type, &d))
+  arr = (PyArrayObject *) PyArray_FROM_OTF (obj, NPY_DOUBLE,
+                                            NPY_ARRAY_IN_ARRAY);
+  if (arr == NULL)
+    return NULL;
+  if (PyArray_NDIM (arr) != 1)
+  {
+    PyErr_Format (PyExc_ValueError, "%s must be a 1D array", name);
+    Py_DECREF (arr);
     return NULL;
+  }
+  if (npoints >= 0 && PyArray_DIM (arr, 0) != npoints)
+  {
+    PyErr_Format (PyExc_ValueError, "%s must have length %zd, got %zd",
+                  name, (Py_ssize_t) npoints,
+                  (Py_ssize_t) PyArray_DIM (arr, 0));
+    Py_DECREF (arr);
+    return NULL;
+  }
+  return arr;
+}
 
+/* Check that a caller supplied buffer is a writeable, C-contiguous double
+   array; if like is given it must have the same shape, otherwise it must
+   hold at least size elements */
+static int
+check_buffer (PyObject * obj, PyArrayObject * like, npy_intp size,
+              const char *name)
+{
+  PyArrayObject *arr;
+  int i;
 
-  /* output array to match the input arrays */
-  out_array = PyArray_NewLikeArray (b, NPY_ANYORDER, NULL, 0);
-  if (out_array == NULL)
+  if (!PyArray_Check (obj))
+  {
+    PyErr_Format (PyExc_TypeError, "%s must be a numpy array", name);
+    return 0;
+  }
+  arr = (PyArrayObject *) obj;
+  if (PyArray_TYPE (arr) != NPY_DOUBLE || !PyArray_IS_C_CONTIGUOUS (arr)
+      || !PyArray_ISWRITEABLE (arr))
+  {
+    PyErr_Format (PyExc_ValueError,
+                  "%s must be a writeable C-contiguous float64 array", name);
+    return 0;
+  }
+  if (like != NULL)
+  {
+    int same = PyArray_NDIM (arr) == PyArray_NDIM (like);
+
+    for (i = 0; same && i < PyArray_NDIM (like); i++)
+      same = PyArray_DIM (arr, i) == PyArray_DIM (like, i);
+    if (!same)
+    {
+      PyErr_Format (PyExc_ValueError,
+                    "%s must have the same shape as d", name);
+      return 0;
+    }
+  }
+  else if (PyArray_SIZE (arr) < size)
+  {
+    PyErr_Format (PyExc_ValueError, "%s must have at least %zd elements, "
+                  "got %zd", name, (Py_ssize_t) size,
+                  (Py_ssize_t) PyArray_SIZE (arr));
+    return 0;
+  }
+  return 1;
+}
+
+static PyObject *
+TDMASolver (PyObject * self, PyObject * args, PyObject * kwds)
+{
+  double *ac, *bc, *cc, *dc, *xc;
+  double *work = NULL;
+  npy_intp npoints;
+  static char *kwlist[] = { "a", "b", "c", "d", "out", "work", NULL };
+
+  /* Variables for calling from Python */
+  PyObject *a_obj, *b_obj, *c_obj, *d_obj;
+  PyObject *out_obj = Py_None, *work_obj = Py_None;
+  PyArrayObject *a = NULL, *b = NULL, *c = NULL, *d = NULL;
+  PyArrayObject *out_array = NULL;
+
+  /*  parse four arrays, optionally followed by output and scratch arrays */
+  if (!PyArg_ParseTupleAndKeywords
+      (args, kwds, "OOOO|OO", kwlist, &a_obj, &b_obj, &c_obj, &d_obj,
+       &out_obj, &work_obj))
     return NULL;
-  acnew = calloc (sizeof (double), a->dimensions[0]);
-  bcnew = calloc (sizeof (double), b->dimensions[0]);
-  ccnew = calloc (sizeof (double), c->dimensions[0]);
-  dcnew = calloc (sizeof (double), d->dimensions[0]);
 
-  npoints = d->dimensions[0];
+  /* inputs are converted to contiguous doubles of matching length, copying
+     only if they are not already */
+  if ((d = vector_argument (d_obj, -1, "d")) == NULL)
+    goto fail;
+  npoints = PyArray_DIM (d, 0);
+  if (npoints < 1)
+  {
+    PyErr_SetString (PyExc_ValueError, "d must not be empty");
+    goto fail;
+  }
+  if ((a = vector_argument (a_obj, npoints, "a")) == NULL)
+    goto fail;
+  if ((b = vector_argument (b_obj, npoints, "b")) == NULL)
+    goto fail;
+  if ((c = vector_argument (c_obj, npoints, "c")) == NULL)
+    goto fail;
 
+  /* write into the caller's output array, or a new one */
+  if (out_obj != Py_None)
+  {
+    if (!check_buffer (out_obj, d, 0, "out"))
+      goto fail;
+    out_array = (PyArrayObject *) out_obj;
+    Py_INCREF (out_array);
+  }
+  else
+  {
+    out_array = (PyArrayObject *) PyArray_SimpleNew (1, &npoints, NPY_DOUBLE);
+    if (out_array == NULL)
+      goto fail;
+  }
+
+  /* scratch space is either supplied by the caller or allocated here */
+  if (work_obj != Py_None)
+  {
+    if (!check_buffer (work_obj, NULL, 2 * npoints, "work"))
+      goto fail;
+    work = (double *) PyArray_DATA ((PyArrayObject *) work_obj);
+  }
+  else
+  {
+    work = malloc (2 * npoints * sizeof (double));
+    if (work == NULL)
+    {
+      PyErr_NoMemory ();
+      goto fail;
+    }
+  }
 
   /* initial and output arrays */
   ac = pyvector_to_Carrayptrs (a);
@@ -48,36 +220,474 @@ TDMASolver (PyObject * self, PyObject * args)
   dc = pyvector_to_Carrayptrs (d);
   xc = pyvector_to_Carrayptrs (out_array);
 
+  /* the sweep touches no Python objects, so other threads can run */
+  Py_BEGIN_ALLOW_THREADS
+  tdma_solve (ac, bc, cc, dc, xc, work, work + npoints, npoints);
+  Py_END_ALLOW_THREADS
+
+  /*  clean up and return the result */
+  if (work_obj == Py_None)
+    free (work);
+  Py_DECREF (a);
+  Py_DECREF (b);
+  Py_DECREF (c);
+  Py_DECREF (d);
+  return (PyObject *) out_array;
+
+fail:
+  Py_XDECREF (a);
+  Py_XDECREF (b);
+  Py_XDECREF (c);
+  Py_XDECREF (d);
+  Py_XDECREF (out_array);
+  return NULL;
+}
+
+/* Convert a batched coefficient to a contiguous double array. Coefficients
+   may be 2D (nsystems, npoints), 1D (npoints) and shared by every system, or
+   a scalar. row_stride is set to the offset between consecutive systems. */
+static PyArrayObject *
+batch_coefficient (PyObject * obj, npy_intp nsystems, npy_intp npoints,
+                   npy_intp * row_stride, const char *name)
+{
+  PyArrayObject *arr, *filled;
+  double value, *data;
+  npy_intp i;
+
+  arr = (PyArrayObject *) PyArray_FROM_OTF (obj, NPY_DOUBLE,
+                                            NPY_ARRAY_IN_ARRAY);
+  if (arr == NULL)
+    return NULL;
+
+  if (PyArray_NDIM (arr) == 0)
+  {
+    /* broadcast a scalar to a shared row */
+    value = *(double *) PyArray_DATA (arr);
+    Py_DECREF (arr);
+    filled = (PyArrayObject *) PyArray_SimpleNew (1, &npoints, NPY_DOUBLE);
+    if (filled == NULL)
+      return NULL;
+    data = (double *) PyArray_DATA (filled);
+    for (i = 0; i < npoints; i++)
+      data[i] = value;
+    *row_stride = 0;
+    return filled;
+  }
+  else if (PyArray_NDIM (arr) == 1 && PyArray_DIM (arr, 0) == npoints)
+  {
+    *row_stride = 0;
+    return arr;
+  }
+  else if (PyArray_NDIM (arr) == 2 && PyArray_DIM (arr, 0) == nsystems
+           && PyArray_DIM (arr, 1) == npoints)
+  {
+    *row_stride = npoints;
+    return arr;
+  }
+
+  PyErr_Format (PyExc_ValueError,
+                "coefficient %s cannot be broadcast to shape (%zd, %zd)",
+                name, (Py_ssize_t) nsystems, (Py_ssize_t) npoints);
+  Py_DECREF (arr);
+  return NULL;
+}
+
+static PyObject *
+TDMASolverBatch (PyObject * self, PyObject * args, PyObject * kwds)
+{
+  double *ac, *bc, *cc, *dc, *xc;
+  double *work = NULL;
+  npy_intp nsystems, npoints, k;
+  npy_intp sa, sb, sc;
+  static char *kwlist[] = { "a", "b", "c", "d", "out", "work", NULL };
+
+  /* Variables for calling from Python */
+  PyObject *a_obj, *b_obj, *c_obj, *d_obj;
+  PyObject *out_obj = Py_None, *work_obj = Py_None;
+  PyArrayObject *a = NULL, *b = NULL, *c = NULL, *d = NULL;
+  PyArrayObject *out_array = NULL;
+
+  if (!PyArg_ParseTupleAndKeywords (args, kwds, "OOOO|OO", kwlist, &a_obj,
+                                    &b_obj, &c_obj, &d_obj, &out_obj,
+                                    &work_obj))
+    return NULL;
+
+  /* the right hand side sets the shape of the batch */
+  d = (PyArrayObject *) PyArray_FROM_OTF (d_obj, NPY_DOUBLE,
+                                          NPY_ARRAY_IN_ARRAY);
+  if (d == NULL)
+    return NULL;
+  if (PyArray_NDIM (d) != 2 || PyArray_DIM (d, 1) < 1)
+  {
+    PyErr_SetString (PyExc_ValueError,
+                     "d must be a 2D array of shape (n_systems, n_bins)");
+    goto fail;
+  }
+  nsystems = PyArray_DIM (d, 0);
+  npoints = PyArray_DIM (d, 1);
+
+  a = batch_coefficient (a_obj, nsystems, npoints, &sa, "a");
+  if (a == NULL)
+    goto fail;
+  b = batch_coefficient (b_obj, nsystems, npoints, &sb, "b");
+  if (b == NULL)
+    goto fail;
+  c = batch_coefficient (c_obj, nsystems, npoints, &sc, "c");
+  if (c == NULL)
+    goto fail;
+
+  if (out_obj != Py_None)
+  {
+    if (!check_buffer (out_obj, d, 0, "out"))
+      goto fail;
+    out_array = (PyArrayObject *) out_obj;
+    Py_INCREF (out_array);
+  }
+  else
+  {
+    out_array = (PyArrayObject *) PyArray_SimpleNew (2, PyArray_DIMS (d),
+                                                     NPY_DOUBLE);
+    if (out_array == NULL)
+      goto fail;
+  }
+
+  /* one scratch buffer shared by every system in the batch */
+  if (work_obj != Py_None)
+  {
+    if (!check_buffer (work_obj, NULL, 2 * npoints, "work"))
+      goto fail;
+    work = (double *) PyArray_DATA ((PyArrayObject *) work_obj);
+  }
+  else
+  {
+    work = malloc (2 * npoints * sizeof (double));
+    if (work == NULL)
+    {
+      PyErr_NoMemory ();
+      goto fail;
+    }
+  }
+
+  ac = (double *) PyArray_DATA (a);
+  bc = (double *) PyArray_DATA (b);
+  cc = (double *) PyArray_DATA (c);
+  dc = (double *) PyArray_DATA (d);
+  xc = (double *) PyArray_DATA (out_array);
+
+  Py_BEGIN_ALLOW_THREADS
+  for (k = 0; k < nsystems; k++)
+  {
+    tdma_solve (ac + k * sa, bc + k * sb, cc + k * sc, dc + k * npoints,
+                xc + k * npoints, work, work + npoints, npoints);
+  }
+  Py_END_ALLOW_THREADS
+
+  if (work_obj == Py_None)
+    free (work);
+  Py_DECREF (a);
+  Py_DECREF (b);
+  Py_DECREF (c);
+  Py_DECREF (d);
+  return (PyObject *) out_array;
+
+fail:
+  Py_XDECREF (a);
+  Py_XDECREF (b);
+  Py_XDECREF (c);
+  Py_XDECREF (d);
+  Py_XDECREF (out_array);
+  return NULL;
+}
+
+static PyObject *
+BidiagonalSolver (PyObject * self, PyObject * args, PyObject * kwds)
+{
+  double *bc, *cc, *dc, *xc;
+  npy_intp nsystems, npoints, k;
+  npy_intp sb, sc;
+  static char *kwlist[] = { "b", "c", "d", "out", NULL };
+
+  /* Variables for calling from Python */
+  PyObject *b_obj, *c_obj, *d_obj, *out_obj = Py_None;
+  PyArrayObject *b = NULL, *c = NULL, *d = NULL;
+  PyArrayObject *out_array = NULL;
+
+  if (!PyArg_ParseTupleAndKeywords (args, kwds, "OOO|O", kwlist, &b_obj,
+                                    &c_obj, &d_obj, &out_obj))
+    return NULL;
+
+  /* d is either a single system or a (n_systems, n_bins) batch */
+  d = (PyArrayObject *) PyArray_FROM_OTF (d_obj, NPY_DOUBLE,
+                                          NPY_ARRAY_IN_ARRAY);
+  if (d == NULL)
+    return NULL;
+  if (PyArray_NDIM (d) == 1)
+  {
+    nsystems = 1;
+    npoints = PyArray_DIM (d, 0);
+  }
+  else if (PyArray_NDIM (d) == 2)
+  {
+    nsystems = PyArray_DIM (d, 0);
+    npoints = PyArray_DIM (d, 1);
+  }
+  else
+  {
+    PyErr_SetString (PyExc_ValueError,
+                     "d must have shape (n_bins) or (n_systems, n_bins)");
+    goto fail;
+  }
+  if (npoints < 1)
+  {
+    PyErr_SetString (PyExc_ValueError, "d must not be empty");
+    goto fail;
+  }
+
+  b = batch_coefficient (b_obj, nsystems, npoints, &sb, "b");
+  if (b == NULL)
+    goto fail;
+  c = batch_coefficient (c_obj, nsystems, npoints, &sc, "c");
+  if (c == NULL)
+    goto fail;
+
+  if (out_obj != Py_None)
+  {
+    if (!check_buffer (out_obj, d, 0, "out"))
+      goto fail;
+    out_array = (PyArrayObject *) out_obj;
+    Py_INCREF (out_array);
+  }
+  else
+  {
+    out_array = (PyArrayObject *) PyArray_SimpleNew (PyArray_NDIM (d),
+                                                     PyArray_DIMS (d),
+                                                     NPY_DOUBLE);
+    if (out_array == NULL)
+      goto fail;
+  }
+
+  bc = (double *) PyArray_DATA (b);
+  cc = (double *) PyArray_DATA (c);
+  dc = (double *) PyArray_DATA (d);
+  xc = (double *) PyArray_DATA (out_array);
+
+  Py_BEGIN_ALLOW_THREADS
+  for (k = 0; k < nsystems; k++)
+  {
+    bidiagonal_solve (bc + k * sb, cc + k * sc, dc + k * npoints,
+                      xc + k * npoints, npoints);
+  }
+  Py_END_ALLOW_THREADS
+
+  Py_DECREF (b);
+  Py_DECREF (c);
+  Py_DECREF (d);
+  return (PyObject *) out_array;
+
+fail:
+  Py_XDECREF (b);
+  Py_XDECREF (c);
+  Py_XDECREF (d);
+  Py_XDECREF (out_array);
+  return NULL;
+}
+
+/* Evolve a particle distribution through a series of target times, choosing
+   the time-step at each step from the shortest bin-crossing or escape time
+   of the populated bins. rate_lower and rate_upper give the coefficients
+   b = 1 + dt (rate_lower + inv_tloss) and c = -dt rate_upper of each step,
+   and rate_cen the bin-crossing rate. All coefficients and sweeps are done
+   here, so the only Python overhead is this single call. */
+static PyObject *
+EvolveUntil (PyObject * self, PyObject * args)
+{
+  double *rate_lo, *rate_hi, *rate_cen, *inv_tloss, *src, *targets;
+  double *n, *n0, *states, *work, *bc, *cc, *rate_cross;
+  double time, target, dt, rmax, rate, nmax, threshold;
+  double t_start, courant, relative_threshold;
+  npy_intp i, k, npoints, ntargets, dims[2], top, ntop, src_top;
+  long nsteps = 0;
+  int stalled = 0;
+  char message[160];
+
+  PyObject *rate_lo_obj, *rate_hi_obj, *rate_cen_obj, *inv_tloss_obj, *src_obj;
+  PyObject *n0_obj, *targets_obj;
+  PyArrayObject *rate_lo_arr = NULL, *rate_hi_arr = NULL, *rate_cen_arr = NULL;
+  PyArrayObject *inv_tloss_arr = NULL, *src_arr = NULL, *n0_arr = NULL;
+  PyArrayObject *targets_arr = NULL, *states_arr = NULL;
+
+  if (!PyArg_ParseTuple (args, "OOOOOOOddd", &rate_lo_obj, &rate_hi_obj,
+                         &rate_cen_obj, &inv_tloss_obj, &src_obj, &n0_obj,
+                         &targets_obj, &t_start, &courant,
+                         &relative_threshold))
+    return NULL;
+
+  rate_lo_arr = vector_argument (rate_lo_obj, -1, "rate_lower");
+  if (rate_lo_arr == NULL)
+    goto fail;
+  npoints = PyArray_DIM (rate_lo_arr, 0);
+  if (npoints < 1)
+  {
+    PyErr_SetString (PyExc_ValueError, "need at least 1 bin");
+    goto fail;
+  }
+
+  if ((rate_hi_arr = vector_argument (rate_hi_obj, npoints, "rate_upper")) == NULL)
+    goto fail;
+  if ((rate_cen_arr = vector_argument (rate_cen_obj, npoints, "rate_cen")) == NULL)
+    goto fail;
+  if ((inv_tloss_arr = vector_argument (inv_tloss_obj, npoints, "inv_tloss")) == NULL)
+    goto fail;
+  if ((src_arr = vector_argument (src_obj, npoints, "source")) == NULL)
+    goto fail;
+  if ((n0_arr = vector_argument (n0_obj, npoints, "n0")) == NULL)
+    goto fail;
+  if ((targets_arr = vector_argument (targets_obj, -1, "targets")) == NULL)
+    goto fail;
+  ntargets = PyArray_DIM (targets_arr, 0);
+
+  dims[0] = ntargets;
+  dims[1] = npoints;
+  states_arr = (PyArrayObject *) PyArray_SimpleNew (2, dims, NPY_DOUBLE);
+  if (states_arr == NULL)
+    goto fail;
+
+  /* current state, the crossing rate and the solver coefficients */
+  work = malloc (4 * npoints * sizeof (double));
+  if (work == NULL)
+  {
+    PyErr_NoMemory ();
+    goto fail;
+  }
+  n = work;
+  rate_cross = work + npoints;
+  bc = work + 2 * npoints;
+  cc = work + 3 * npoints;
+
+  rate_lo = (double *) PyArray_DATA (rate_lo_arr);
+  rate_hi = (double *) PyArray_DATA (rate_hi_arr);
+  rate_cen = (double *) PyArray_DATA (rate_cen_arr);
+  inv_tloss = (double *) PyArray_DATA (inv_tloss_arr);
+  src = (double *) PyArray_DATA (src_arr);
+  targets = (double *) PyArray_DATA (targets_arr);
+  states = (double *) PyArray_DATA (states_arr);
+
+  n0 = (double *) PyArray_DATA (n0_arr);
+
+  /* nothing below touches Python objects, so other threads can run */
+  Py_BEGIN_ALLOW_THREADS
+
+  /* the fastest of the bin-crossing and escape rates is fixed for the run */
   for (i = 0; i < npoints; i++)
   {
-    bcnew[i] = bc[i];
-    dcnew[i] = dc[i];
+    rate_cross[i] = rate_cen[i];
+    if (inv_tloss[i] > rate_cross[i])
+      rate_cross[i] = inv_tloss[i];
+    n[i] = n0[i];
   }
 
-  for (i = 1; i < npoints; i++)
+  /* particles only move down in energy, so bins above the highest
+     populated or source bin stay empty and each step works below them */
+  src_top = npoints;
+  while (src_top > 0 && src[src_top - 1] == 0.0)
+    src_top--;
+  ntop = npoints;
+  while (ntop > 0 && n[ntop - 1] == 0.0)
+    ntop--;
+
+  time = t_start;
+  for (k = 0; k < ntargets; k++)
   {
-    // printf ("%.1f %.1f %.1f %.1f\n", ac[i], bc[i],cc[i], dc[i]);
-    mc = ac[i-1] / bcnew[i-1];
-    bcnew[i] = bcnew[i] - mc * cc[i - 1]; 
-    dcnew[i] = dcnew[i] - mc * dcnew[i - 1];
+    target = targets[k];
+    while (time < target)
+    {
+      top = (ntop > src_top) ? ntop : src_top;
+
+      /* zero bins below the relative threshold */
+      nmax = 0.0;
+      for (i = 0; i < top; i++)
+        if (n[i] > nmax)
+          nmax = n[i];
+      threshold = nmax * relative_threshold;
+
+      /* fastest rate over the populated bins, or all bins if empty */
+      rmax = 0.0;
+      for (i = 0; i < top; i++)
+      {
+        if (nmax > 0.0 && !(n[i] > threshold))
+        {
+          n[i] = 0.0;
+          continue;
+        }
+        rate = rate_cross[i];
+        if (rate > rmax)
+          rmax = rate;
+      }
+
+      dt = (rmax > 0.0) ? courant / rmax : target - time;
+      if (dt >= target - time)
+        dt = target - time;
+      else if (!(dt > 0.0) || time + dt == time)
+      {
+        /* the step is lost in the rounding of time, so the loop would
+           never end */
+        stalled = 1;
+        goto done;
+      }
+
+      /* the right hand side is built in place, as the sweep only reads
+         each entry before overwriting it */
+      for (i = 0; i < top; i++)
+      {
+        bc[i] = 1.0 + dt * (rate_lo[i] + inv_tloss[i]);
+        cc[i] = -dt * rate_hi[i];
+        n[i] = n[i] + src[i] * dt;
+      }
+      ntop = (top > 0) ? bidiagonal_solve (bc, cc, n, n, top) : 0;
+
+      if (dt == target - time)
+        time = target;
+      else
+        time += dt;
+      nsteps++;
+    }
+
+    for (i = 0; i < npoints; i++)
+      states[k * npoints + i] = n[i];
   }
 
-  /* set boundary condition */
-  xc[npoints - 1] = dcnew[npoints - 1] / bcnew[npoints - 1];
+done:
+  Py_END_ALLOW_THREADS
 
-  /* second sweep */
-  for (i = npoints - 2; i > -1; i--)
+  free (work);
+  if (stalled)
   {
-    xc[i] = (dcnew[i] - cc[i] * xc[i+1]) / bcnew[i];
+    PyOS_snprintf (message, sizeof (message),
+                   "time-step %g does not advance the time %g, the loss "
+                   "or escape rates are too large", dt, time);
+    PyErr_SetString (PyExc_RuntimeError, message);
+    goto fail;
   }
 
-  /*  clean up and return the result */
-  free (acnew);
-  free (bcnew);
-  free (ccnew);
-  free (dcnew);
-  Py_INCREF (out_array);
-  return Py_BuildValue("O", out_array);
+  Py_DECREF (rate_lo_arr);
+  Py_DECREF (rate_hi_arr);
+  Py_DECREF (rate_cen_arr);
+  Py_DECREF (inv_tloss_arr);
+  Py_DECREF (src_arr);
+  Py_DECREF (n0_arr);
+  Py_DECREF (targets_arr);
+  return Py_BuildValue ("Nl", states_arr, nsteps);
+
+fail:
+  Py_XDECREF (rate_lo_arr);
+  Py_XDECREF (rate_hi_arr);
+  Py_XDECREF (rate_cen_arr);
+  Py_XDECREF (inv_tloss_arr);
+  Py_XDECREF (src_arr);
+  Py_XDECREF (n0_arr);
+  Py_XDECREF (targets_arr);
+  Py_XDECREF (states_arr);
+  return NULL;
 }
 
 /* Create 1D Carray from PyArray
@@ -85,10 +695,7 @@ TDMASolver (PyObject * self, PyObject * args)
 double *
 pyvector_to_Carrayptrs (PyArrayObject * arrayin)
 {
-  int n;
-
-  n = arrayin->dimensions[0];
-  return (double *) arrayin->data;  /* pointer to arrayin data as double */
+  return (double *) PyArray_DATA (arrayin);  /* pointer to arrayin data as double */
 }
 
 
@@ -96,8 +703,32 @@ pyvector_to_Carrayptrs (PyArrayObject * arrayin)
 
 /*  define functions in module */
 static PyMethodDef TDMAMethods[] = {
-  {"TDMASolver", TDMASolver, METH_VARARGS,
-   "Tridiagonal matrix algorithm"},
+  {"TDMASolver", (PyCFunction) TDMASolver, METH_VARARGS | METH_KEYWORDS,
+   "TDMASolver(a, b, c, d, out=None, work=None)\n\n"
+   "Tridiagonal matrix algorithm. The solution is written to out if given, "
+   "which must have the shape of d and may be d itself. work is optional caller-owned scratch space of "
+   "at least 2 * len(d) doubles, so repeated calls need not allocate."},
+  {"TDMASolverBatch", (PyCFunction) TDMASolverBatch,
+   METH_VARARGS | METH_KEYWORDS,
+   "TDMASolverBatch(a, b, c, d, out=None, work=None)\n\n"
+   "Tridiagonal matrix algorithm for a batch of independent systems. "
+   "d has shape (n_systems, n_bins); a, b and c may have the same shape, "
+   "be a single (n_bins) row shared by every system, or be scalars. out "
+   "and work are as for TDMASolver, with work needing 2 * n_bins doubles."},
+  {"BidiagonalSolver", (PyCFunction) BidiagonalSolver,
+   METH_VARARGS | METH_KEYWORDS,
+   "BidiagonalSolver(b, c, d, out=None)\n\n"
+   "Solve an upper bidiagonal system, i.e. the tridiagonal system with "
+   "a == 0, by back substitution. Bins above the highest non-zero entry "
+   "of d are set to zero without being solved. d may be a single system "
+   "or have shape (n_systems, n_bins), with b and c broadcast as for "
+   "TDMASolverBatch. out may alias d."},
+  {"EvolveUntil", EvolveUntil, METH_VARARGS,
+   "EvolveUntil(rate_lower, rate_upper, rate_cen, inv_tloss, source, n0, "
+   "targets, t_start, courant, relative_threshold)\n\n"
+   "Evolve a distribution with adaptive time-steps through a sorted array "
+   "of target times, returning the state at each target and the number "
+   "of steps taken."},
   {NULL, NULL, 0, NULL}
 };
 
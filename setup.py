@@ -2,7 +2,7 @@ from distutils.core import setup, Extension
 import numpy
 
 # define the extension module for the TDMA algorithm 
-tdma_module = Extension('tdma',
+tdma_module = Extension('msynchro.tdma',
                     include_dirs=[numpy.get_include()],
                     sources = ['msynchro/tdma.c'])
 
@@ -1,4 +1,8 @@
 import numpy as np 
+import os
+import subprocess
+import sys
+import tempfile
 import matplotlib.pyplot as plt 
 import constants as const 
 import msynchro
@@ -227,7 +231,527 @@ def run_delta_test():
     plt.ylabel("$n(E)$")
     plt.savefig("delta_test.png")
 
+def convergence_order(scheme, ne0, measure, tmax, nsteps=(8,16,32,64), nref=16384):
+    '''
+    Evolve ne0 for tmax with increasing numbers of fixed steps and return
+    the observed orders of convergence against a run with nref steps.
+    '''
+    B = 6e-6
+    rest_mass_ev = unit.melec * unit.c * unit.c / unit.ev
+
+    Emin = np.log10(10.0 * rest_mass_ev)
+    Emax = np.log10(1e9 * rest_mass_ev)
+    energy_edges = np.logspace(Emin,Emax,2001)
+    energy_loss_rate = cooling_rate(energy_edges / rest_mass_ev, B, 0.0) / unit.ev
+
+    evolver = msynchro.evolve.Evolver(energy_edges, energy_loss_rate, 0.0, 0.0, scheme=scheme)
+
+    def run(n):
+        ne = ne0.copy()
+        for i in range(n):
+            evolver.step(ne, tmax / n, out=ne)
+        return ne
+
+    ne_ref = run(nref)
+    errors = np.array([measure(run(n), ne_ref) for n in nsteps])
+    return np.log2(errors[:-1] / errors[1:])
+
+
+def run_convergence_test():
+    '''
+    Check the order of convergence in time of each scheme for the
+    power-law and delta function tests.
+    '''
+    B = 6e-6
+    rest_mass_ev = unit.melec * unit.c * unit.c / unit.ev
+    Emin = np.log10(10.0 * rest_mass_ev)
+    Emax = np.log10(1e9 * rest_mass_ev)
+    energy_edges = np.logspace(Emin,Emax,2001)
+    energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    Ebins = energy_edges[1:] - energy_edges[:-1]
+
+    tmax = 2.0 * unit.myr
+    C_E = cooling_rate(energies / rest_mass_ev, B, 0.0) / unit.ev / energies / energies
+
+    # power-law: relative L1 error well below the cooling break
+    select = (energies > 1e9) * (energies < 0.3 / C_E / tmax)
+    def powerlaw_error(ne, ne_ref):
+        return np.sum(np.fabs(ne - ne_ref)[select]) / np.sum(ne_ref[select])
+
+    # delta function: error in the mean energy of the cooled particles
+    def mean_energy(ne):
+        return np.sum(ne * energies * Ebins) / np.sum(ne * Ebins)
+    def delta_error(ne, ne_ref):
+        return np.fabs(mean_energy(ne) / mean_energy(ne_ref) - 1.0)
+
+    ne_delta = np.zeros_like(energies)
+    ne_delta[np.argmin(np.fabs(energies - 1e12))] = 1
+
+    for scheme, expected in (("implicit", 1), ("crank-nicolson", 2)):
+        for name, ne0, measure in (("power-law", energies ** -2.5, powerlaw_error),
+                                   ("delta", ne_delta, delta_error)):
+            orders = convergence_order(scheme, ne0, measure, tmax)
+            print ("{} {}: observed orders {}".format(scheme, name, np.round(orders, 2)))
+            assert np.all(np.fabs(orders - expected) < 0.1)
+
+
+def run_evolve_until_test():
+    '''
+    Check that evolve_until takes the same steps as particle_evolve, for a
+    scalar loss rate, which is a rate rather than dE/dt, and for loss
+    rates given at the bin edges.
+    '''
+    energy_edges = np.logspace(0, 3, 301)
+    energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    Ebins = energy_edges[1:] - energy_edges[:-1]
+    ne0 = np.exp(-((np.log(energies) - np.log(300.0)) / 0.3) ** 2)
+    tmax, courant = 0.5, 0.4
+
+    edge_rate = 1e-3 * energy_edges ** 2
+    for energy_loss_rate, crossing_rate in ((5.0, np.full_like(energies, 5.0)),
+                                            (edge_rate, 0.5 * (edge_rate[1:] + edge_rate[:-1]) / Ebins)):
+        # the fixed time-steps evolve_until takes with no threshold
+        ne = ne0.copy()
+        time = 0.0
+        while time < tmax:
+            delta_t = min(courant / np.max(crossing_rate), tmax - time)
+            ne = msynchro.evolve.particle_evolve(energy_edges, energy_loss_rate, 0.0, 0.0, ne, delta_t)
+            time = tmax if delta_t == tmax - time else time + delta_t
+
+        ne_until = msynchro.evolve.evolve_until(energy_edges, energy_loss_rate, 0.0, 0.0, ne0, tmax,
+                                                courant=courant, relative_threshold=0.0)
+        error = np.max(np.fabs(ne_until - ne)) / np.max(ne)
+        print ("evolve_until against particle_evolve: {:.2e}".format(error))
+        assert error < 1e-12
+
+
+def run_remesh_test():
+    '''
+    Check that evolving on an AdaptiveMesh stays within rtol of evolving
+    on the base grid, with cooling, escape and injection, and that the
+    error shrinks as rtol is tightened.
+    '''
+    B = 6e-6
+    rest_mass_ev = unit.melec * unit.c * unit.c / unit.ev
+    Emin = np.log10(10.0 * rest_mass_ev)
+    Emax = np.log10(1e8 * 10.0 * rest_mass_ev)
+    energy_edges = np.logspace(Emin,Emax,10001)
+    energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    energy_loss_rate = cooling_rate(energy_edges / rest_mass_ev, B, 0.0) / unit.ev
+    source = energies ** -2.2 * np.exp(-energies / 1e13)
+    tloss, delta_t, nsteps = 1e14, 1e11, 1000
+
+    evolver = msynchro.evolve.Evolver(energy_edges, energy_loss_rate, tloss, source)
+    ne = np.zeros_like(energies)
+    for i in range(nsteps):
+        ne = evolver.step(ne, delta_t, out=ne)
+    select = ne > 1e-15 * np.max(ne)
+
+    errors = []
+    for rtol in (1e-2, 1e-3):
+        ne_mesh, mesh = msynchro.remesh.evolve_remeshed(energy_edges, energy_loss_rate, tloss, source,
+                                                        np.zeros_like(energies), delta_t, nsteps, rtol=rtol)
+        errors.append(np.max(np.fabs(ne_mesh[select] / ne[select] - 1.0)))
+        print ("remesh rtol {:.0e}: {} bins, max error {:.2e}".format(rtol, mesh.nbins, errors[-1]))
+        assert errors[-1] < rtol
+
+    assert errors[1] < errors[0]
+
+
+def tridiagonal_matrix(a, b, c):
+    '''
+    Dense matrix with sub-diagonal a[:-1], diagonal b and super-diagonal
+    c[:-1], as the TDMA solvers read them, to check against np.linalg.solve.
+    '''
+    return np.diag(b) + np.diag(a[:-1], -1) + np.diag(c[:-1], 1)
+
+
+def run_tdma_batch_test(nsystems=4, npoints=50):
+    '''
+    Check that TDMASolverBatch agrees with TDMASolver called on each system
+    and with np.linalg.solve, for per-system, shared and scalar coefficients.
+    '''
+    rng = np.random.default_rng(1)
+    a = -rng.random((nsystems, npoints))
+    c = -rng.random((nsystems, npoints))
+    b = 3.0 + rng.random((nsystems, npoints))
+    d = rng.random((nsystems, npoints))
+
+    for coefficients in ((a, b, c), (a[0], b[0], c[0]), (-1.0, 3.0, -1.0)):
+        full = [np.broadcast_to(x, (nsystems, npoints)) for x in coefficients]
+        x = msynchro.tdma.TDMASolverBatch(*coefficients, d)
+        for i in range(nsystems):
+            single = msynchro.tdma.TDMASolver(full[0][i], full[1][i], full[2][i], d[i])
+            exact = np.linalg.solve(tridiagonal_matrix(full[0][i], full[1][i], full[2][i]), d[i])
+            assert np.array_equal(x[i], single)
+            assert np.allclose(x[i], exact, rtol=1e-12, atol=0.0)
+    print ("TDMASolverBatch against TDMASolver and np.linalg.solve: ok")
+
+
+def run_tdma_buffers_test(nsystems=4, npoints=50):
+    '''
+    Check that TDMASolver and TDMASolverBatch give the same answer when
+    writing into out, including out aliasing d, and with a reused work
+    buffer, and that they return out itself.
+    '''
+    rng = np.random.default_rng(2)
+    a = -rng.random(npoints)
+    c = -rng.random(npoints)
+    b = 3.0 + rng.random(npoints)
+    d = rng.random((nsystems, npoints))
+    work = np.empty(2 * npoints)
+
+    for i in range(nsystems):
+        x = msynchro.tdma.TDMASolver(a, b, c, d[i])
+        out = np.empty(npoints)
+        assert msynchro.tdma.TDMASolver(a, b, c, d[i], out=out, work=work) is out
+        assert np.array_equal(out, x)
+        aliased = d[i].copy()
+        assert msynchro.tdma.TDMASolver(a, b, c, aliased, out=aliased, work=work) is aliased
+        assert np.array_equal(aliased, x)
+
+    x = msynchro.tdma.TDMASolverBatch(a, b, c, d)
+    aliased = d.copy()
+    assert msynchro.tdma.TDMASolverBatch(a, b, c, aliased, out=aliased, work=work) is aliased
+    assert np.array_equal(aliased, x)
+    print ("TDMA solvers with out and work buffers: ok")
+
+
+def run_tdma_rejection_test(npoints=50):
+    '''
+    Check that the TDMA solvers reject coefficients of the wrong length,
+    out buffers of the wrong dtype or shape and a work buffer that is too
+    small, rather than reading or writing out of bounds.
+    '''
+    a = np.full(npoints, -1.0)
+    b = np.full(npoints, 3.0)
+    c = np.full(npoints, -1.0)
+    d = np.ones(npoints)
+    tdma = msynchro.tdma
+    calls = [
+        lambda: tdma.TDMASolver(a[:-1], b, c, d),
+        lambda: tdma.TDMASolver(a, b, c, d[:-1]),
+        lambda: tdma.TDMASolver(a, b, c, d, out=np.empty(npoints, dtype=np.float32)),
+        lambda: tdma.TDMASolver(a, b, c, d, out=np.empty(npoints + 1)),
+        lambda: tdma.TDMASolver(a, b, c, d, out=np.empty((1, npoints))),
+        lambda: tdma.TDMASolver(a, b, c, d, work=np.empty(2 * npoints - 1)),
+        lambda: tdma.TDMASolverBatch(a[:-1], b, c, np.ones((2, npoints))),
+        lambda: tdma.TDMASolverBatch(a, b, c, np.ones((2, npoints)), out=np.empty((npoints, 2))),
+        lambda: tdma.TDMASolverBatch(a, b, c, np.ones((2, npoints)), out=np.empty(2 * npoints)),
+        lambda: tdma.TDMASolverBatch(a, b, c, np.ones((2, npoints)), work=np.empty(npoints)),
+        lambda: tdma.BidiagonalSolver(b, c[:-1], d),
+        lambda: tdma.BidiagonalSolver(b, c, np.ones((2, npoints)), out=np.empty((npoints, 2))),
+    ]
+    for call in calls:
+        try:
+            call()
+        except (TypeError, ValueError):
+            continue
+        raise AssertionError("invalid TDMA arguments were accepted")
+    print ("TDMA solvers reject invalid arguments: ok")
+
+
+def run_bidiagonal_test(nsystems=3, npoints=50, top=20):
+    '''
+    Check that BidiagonalSolver agrees with the full TDMASolver with a == 0,
+    for a right hand side whose top bins are zero, as for pure cooling,
+    one that fills every bin and one that is zero everywhere.
+    '''
+    rng = np.random.default_rng(3)
+    b = 1.0 + rng.random(npoints)
+    c = -rng.random(npoints)
+    zeros = np.zeros(npoints)
+    d = rng.random((nsystems, npoints))
+    d[0, top:] = 0.0
+    d[2] = 0.0
+
+    x = msynchro.tdma.BidiagonalSolver(b, c, d)
+    for i in range(nsystems):
+        full = msynchro.tdma.TDMASolver(zeros, b, c, d[i])
+        assert np.array_equal(x[i], full)
+        assert np.array_equal(msynchro.tdma.BidiagonalSolver(b, c, d[i]), x[i])
+    assert not np.any(x[0, top:]) and not np.any(x[2])
+    print ("BidiagonalSolver against TDMASolver: ok")
+
+
+def run_checkpoint_test(nbins=500):
+    '''
+    Check that a run of evolve_checkpointed interrupted part way and
+    resumed is bit-for-bit identical to an uninterrupted run, for an Evolver
+    and an AdaptiveStepper, and that resuming with a different dt or n0
+    raises ValueError.
+    '''
+    B = 6e-6
+    rest_mass_ev = unit.melec * unit.c * unit.c / unit.ev
+    energy_edges = np.logspace(np.log10(10.0 * rest_mass_ev), np.log10(1e8 * 10.0 * rest_mass_ev), nbins + 1)
+    energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    energy_loss_rate = cooling_rate(energy_edges / rest_mass_ev, B, 0.0) / unit.ev
+    source = np.where(energies < 1e13, energies ** -2.2, 0.0)
+    ne0 = np.zeros_like(energies)
+    t_end, interval = 1e14, 7e12
+
+    class Interrupted(Exception):
+        pass
+
+    def make(adaptive):
+        evolver = msynchro.evolve.Evolver(energy_edges, energy_loss_rate, 1e14, source, scheme="crank-nicolson")
+        return msynchro.evolve.AdaptiveStepper(evolver, rtol=1e-4) if adaptive else evolver
+
+    def counting(stepper, calls, stop=None):
+        # count the time-steps of a run, stopping it as if the process
+        # were killed when the count reaches stop
+        evolver = stepper.evolver if isinstance(stepper, msynchro.evolve.AdaptiveStepper) else stepper
+        step = evolver.step
+        def counted_step(*args, **kwargs):
+            calls.append(None)
+            if len(calls) == stop:
+                raise Interrupted()
+            return step(*args, **kwargs)
+        evolver.step = counted_step
+        return stepper
+
+    with tempfile.TemporaryDirectory() as directory:
+        fname = os.path.join(directory, "run.npz")
+        for adaptive, dt in ((False, 3e11), (True, None)):
+            steps = []
+            full = msynchro.checkpoint.evolve_checkpointed(counting(make(adaptive), steps), ne0, t_end, fname,
+                                                           interval, dt=dt, resume=False)
+            os.remove(fname)
+
+            try:
+                msynchro.checkpoint.evolve_checkpointed(counting(make(adaptive), [], 9 * len(steps) // 10), ne0, t_end,
+                                                        fname, interval, dt=dt)
+                raise AssertionError("the run was not interrupted")
+            except Interrupted:
+                pass
+            assert 0.0 < msynchro.checkpoint.load_checkpoint(fname)["time"] < t_end
+
+            resumed = msynchro.checkpoint.evolve_checkpointed(make(adaptive), ne0, t_end, fname, interval, dt=dt)
+            print ("checkpoint resume, adaptive={}: identical {}".format(adaptive, np.array_equal(resumed, full)))
+            assert np.array_equal(resumed, full)
+            os.remove(fname)
+
+        # a checkpoint of a different run is not resumed
+        msynchro.checkpoint.evolve_checkpointed(make(False), ne0, interval, fname, interval, dt=3e11)
+        for changed in (dict(dt=2e11), dict(n0=np.ones_like(energies))):
+            arguments = dict(dt=3e11, n0=ne0)
+            arguments.update(changed)
+            try:
+                msynchro.checkpoint.evolve_checkpointed(make(False), arguments["n0"], interval, fname, interval,
+                                                        dt=arguments["dt"])
+                raise AssertionError("resumed a checkpoint with a different {}".format(*changed))
+            except ValueError:
+                pass
+
+
+def run_analytic_cool_test(p=2.5):
+    '''
+    Check analytic_cool against the exact solution for a power law
+    n0 = E^-p under dE/dt = -C E^2, whose particles now at E started at
+    E / (1 - C E t), comparing bin averages. Sharing each bin as if
+    uniformly filled makes the error first order in the bin width. Also
+    check that the number of particles only changes by those cooling off
+    the grid.
+    '''
+    B = 6e-6
+    rest_mass_ev = unit.melec * unit.c * unit.c / unit.ev
+    C = cooling_rate(1.0, B, 0.0) / unit.ev / rest_mass_ev ** 2
+
+    for t in (1.0 * unit.myr, 5.0 * unit.myr):
+        errors = []
+        for nbins in (1000, 2000):
+            energy_edges = np.logspace(np.log10(10.0 * rest_mass_ev), np.log10(1e9 * rest_mass_ev), nbins + 1)
+            energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+            Ebins = energy_edges[1:] - energy_edges[:-1]
+            ne0 = np.diff(energy_edges ** (1.0 - p) / (1.0 - p)) / Ebins
+            ne = msynchro.evolve.analytic_cool(energy_edges, ne0, C, t)
+
+            # the energy each edge started at, infinite above the cut-off
+            initial = np.full_like(energy_edges, np.inf)
+            cooling = C * energy_edges * t < 1.0
+            initial[cooling] = energy_edges[cooling] / (1.0 - C * energy_edges[cooling] * t)
+            exact = np.diff(initial ** (1.0 - p) / (1.0 - p)) / Ebins
+            select = (energies > 1e9) & (energies < 0.5 / (C * t))
+            errors.append(np.max(np.fabs(ne[select] / exact[select] - 1.0)))
+
+            # particles only leave through the lowest edge, those whose
+            # cooled energy is now below it
+            number = np.append(0.0, np.cumsum(ne0 * Ebins))
+            lost = np.interp(energy_edges[0], energy_edges / (1.0 + C * energy_edges * t), number)
+            assert np.fabs(np.sum(ne * Ebins) + lost - number[-1]) < 1e-12 * number[-1]
+
+        print ("analytic_cool against the exact solution: errors {:.2e} {:.2e}".format(*errors))
+        assert errors[1] < 2e-3
+        assert 1.8 < errors[0] / errors[1] < 2.2
+
+
+def run_green_test(nbins=500, nsteps=400):
+    '''
+    Check that GreenFunction.evolve matches stepping particle_evolve with
+    the same injection history, to FFT round-off, for one source component
+    and for two with independent histories.
+    '''
+    energy_edges = np.logspace(0, 4, nbins + 1)
+    energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    energy_loss_rate = 1e-3 * energy_edges ** 2
+    source = energies ** -2.0 * np.exp(-energies / 3e3)
+    tloss, delta_t = 20.0, 0.05
+    history = 1.0 + np.sin(0.1 * np.arange(nsteps))
+
+    ne = np.zeros_like(energies)
+    stepped = np.empty((nsteps, nbins))
+    for m in range(nsteps):
+        ne = msynchro.evolve.particle_evolve(energy_edges, energy_loss_rate, tloss, history[m] * source, ne, delta_t)
+        stepped[m] = ne
+
+    green = msynchro.green.GreenFunction(energy_edges, energy_loss_rate, tloss, source, delta_t, nsteps)
+    error = np.max(np.fabs(green.evolve(history) - stepped)) / np.max(stepped)
+
+    components = msynchro.green.GreenFunction(energy_edges, energy_loss_rate, tloss, np.stack([source, 2.0 * source]),
+                                              delta_t, nsteps)
+    error_components = np.max(np.fabs(components.evolve(np.stack([history, history], axis=1)) - 3.0 * stepped))
+    error_components /= 3.0 * np.max(stepped)
+
+    print ("GreenFunction against stepping: {:.2e}, two components {:.2e}".format(error, error_components))
+    assert error < 1e-12 and error_components < 1e-12
+
+
+def run_steady_state_test(nbins=1000):
+    '''
+    Check that steady_state matches the state a long integration with an
+    Evolver settles to, with escape and with cooling alone, where the
+    implicit steps can be much longer than the cooling time.
+    '''
+    energy_edges = np.logspace(0, 4, nbins + 1)
+    energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    energy_loss_rate = 1e-3 * energy_edges ** 2
+    source = energies ** -2.0 * np.exp(-energies / 3e3)
+
+    for tloss, delta_t, nsteps in ((20.0, 1.0, 2000), (None, 100.0, 1000)):
+        evolver = msynchro.evolve.Evolver(energy_edges, energy_loss_rate, tloss, source)
+        ne = np.zeros_like(energies)
+        for i in range(nsteps):
+            ne = evolver.step(ne, delta_t, out=ne)
+
+        steady = msynchro.evolve.steady_state(energy_edges, energy_loss_rate, tloss, source)
+        error = np.max(np.fabs(ne / steady - 1.0))
+        print ("steady_state against evolving, tloss {}: {:.2e}".format(tloss, error))
+        assert error < 1e-12
+
+
+def run_adaptive_test(nbins=500, nref=20000):
+    '''
+    Check the error of AdaptiveStepper against a Crank-Nicolson run with
+    nref fixed time-steps, for injection switched on at t = 0. rtol bounds
+    the error of each step, so the error at t_end should shrink roughly as
+    rtol^(order / (order + 1)), a factor of 3 to 5 per decade of rtol.
+    '''
+    energy_edges = np.logspace(0, 4, nbins + 1)
+    energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    energy_loss_rate = 1e-3 * energy_edges ** 2
+    source = energies ** -2.0 * np.exp(-energies / 3e3)
+    tloss, t_end = 20.0, 40.0
+
+    evolver = msynchro.evolve.Evolver(energy_edges, energy_loss_rate, tloss, source, scheme="crank-nicolson")
+    ne = np.zeros_like(energies)
+    for i in range(nref):
+        ne = evolver.step(ne, t_end / nref, out=ne)
+    select = ne > 1e-10 * np.max(ne)
+
+    for scheme in ("implicit", "crank-nicolson"):
+        evolver = msynchro.evolve.Evolver(energy_edges, energy_loss_rate, tloss, source, scheme=scheme)
+        errors = []
+        for rtol in (1e-2, 1e-3, 1e-4):
+            stepper = msynchro.evolve.AdaptiveStepper(evolver, rtol=rtol)
+            ne_adaptive = stepper.advance(np.zeros_like(energies), t_end)
+            errors.append(np.max(np.fabs(ne_adaptive[select] / ne[select] - 1.0)))
+        decades = np.log10(np.array(errors[:-1]) / np.array(errors[1:]))
+        print ("adaptive {} against fixed dt: errors {}, per decade of rtol {}".format(
+            scheme, " ".join("{:.2e}".format(error) for error in errors), np.round(decades, 2)))
+        assert errors[0] < 0.05
+        assert np.all(decades > 0.4) and np.all(decades < 0.8)
+
+
+def run_scheduled_test(nbins=1000, nsteps=300):
+    '''
+    Check that evolve_scheduled, for a decaying field, growing escape rate
+    and decaying injection, matches stepping an Evolver rebuilt each step
+    from the inputs at the end of the step, with the schedules given as
+    functions and as tables sampled at the step times.
+    '''
+    rest_mass_ev = unit.melec * unit.c * unit.c / unit.ev
+    energy_edges = np.logspace(np.log10(10.0 * rest_mass_ev), np.log10(1e8 * 10.0 * rest_mass_ev), nbins + 1)
+    energies = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    gammas = energy_edges / rest_mass_ev
+    tloss = np.full_like(energies, 3e14)
+    source = np.where(energies < 1e13, energies ** -2.2, 0.0)
+    delta_t = 1e12
+
+    field = lambda t: 1e-5 / (1.0 + t / 1e14)
+    escape = lambda t: 1.0 + t / 1e14
+    injection = lambda t: np.exp(-t / 2e14)
+
+    ne = np.zeros_like(energies)
+    for i in range(1, nsteps + 1):
+        t = i * delta_t
+        evolver = msynchro.evolve.Evolver(energy_edges, cooling_rate(gammas, field(t)) / unit.ev,
+                                          tloss / escape(t), injection(t) * source)
+        ne = evolver.step(ne, delta_t, out=ne)
+    select = ne > 1e-12 * np.max(ne)
+
+    # synchrotron losses for B = 1 scaled by B(t)^2, and inverse Compton
+    components = np.array([cooling_rate(gammas, 1.0, 0.0), cooling_rate(gammas, 0.0)]) / unit.ev
+    times = delta_t * np.arange(nsteps + 1)
+    for schedules in ((lambda t: (field(t) ** 2, 1.0), escape, injection),
+                      ((times, np.stack([field(times) ** 2, np.ones_like(times)], axis=1)),
+                       (times, escape(times)), (times, injection(times)))):
+        ne_scheduled = msynchro.evolve.evolve_scheduled(energy_edges, components, tloss, source,
+                                                        np.zeros_like(energies), nsteps * delta_t, delta_t,
+                                                        loss_scale=schedules[0], escape_scale=schedules[1],
+                                                        source_scale=schedules[2])
+        error = np.max(np.fabs(ne_scheduled[select] / ne[select] - 1.0))
+        print ("evolve_scheduled against a rebuilt Evolver: {:.2e}".format(error))
+        assert error < 1e-10
+
+
+def run_import_test(budget=0.1, repeat=5):
+    '''
+    Check that importing msynchro stays within budget seconds on top of
+    numpy, and does not import scipy or the optional submodules, which
+    are loaded on first use.
+    '''
+    code = ("import time, sys, numpy; start = time.perf_counter(); import msynchro; "
+            "print(time.perf_counter() - start); "
+            "print(' '.join(m for m in sys.modules if m.startswith(('scipy', 'msynchro.'))))")
+
+    # best of several fresh interpreters, so a busy machine does not fail the test
+    times = []
+    for i in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", code]).decode().split("\n")
+        times.append(float(output[0]))
+    loaded = output[1].split()
+
+    print ("import msynchro: {:.4f}s, loaded {}".format(min(times), loaded))
+    assert not any(name.startswith("scipy") for name in loaded)
+    assert "msynchro.evolve" not in loaded
+    assert min(times) < budget
+
+
 if __name__ == "__main__":
     set_mpl_defaults()
     run_delta_test()
     run_powerlaw_test()
+    run_convergence_test()
+    run_evolve_until_test()
+    run_remesh_test()
+    run_tdma_batch_test()
+    run_tdma_buffers_test()
+    run_tdma_rejection_test()
+    run_bidiagonal_test()
+    run_checkpoint_test()
+    run_analytic_cool_test()
+    run_green_test()
+    run_steady_state_test()
+    run_adaptive_test()
+    run_scheduled_test()
+    run_import_test()